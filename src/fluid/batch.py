@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import taichi as ti
+
+from headless import load_scene
+
+# Per-scene parameters accepted in a variation, see WCSPHSolver.set_scene_parameters
+SCENE_PARAMETERS = ('gravity', 'viscosity', 'stiffness', 'dt')
+
+
+def build_batched_scene(scene, variations):
+    # One ParticleSystem and solver holding a copy of scene for every entry of variations
+    from particle_system import ParticleSystem
+    from wcsph import WCSPHSolver
+
+    scene_num = len(variations)
+    ps_kwargs = dict(scene['particle_system'])
+    if 'particle_max_num' not in ps_kwargs:
+        # Upper bound on the particles of one copy: the lattice points add_cube and add_sphere sample
+        spacing = 0.1 * 2.8
+        count = sum(np.prod(np.ceil(np.asarray(c['cube_size']) / spacing)) for c in scene['cubes'])
+        count += sum(np.ceil(2 * s['radius'] / spacing) ** len(scene['domain']) for s in scene['spheres'])
+        ps_kwargs['particle_max_num'] = max(int(count) * scene_num, 1)
+    ps = ParticleSystem(tuple(scene['domain']), scene_num=scene_num, **ps_kwargs)
+    for s in range(scene_num):
+        for cube in scene['cubes']:
+            ps.add_cube(scene=s, **cube)
+        for sphere in scene['spheres']:
+            ps.add_sphere(scene=s, **sphere)
+    # The static boundary is shared
+    for box in scene['boundary_boxes']:
+        ps.add_boundary_box(**box)
+    solver_kwargs = dict(scene['solver'])
+    solver_kwargs['adaptive_dt'] = False
+    solver = WCSPHSolver(ps, **solver_kwargs)
+    for s, variation in enumerate(variations):
+        for name in variation:
+            assert name in SCENE_PARAMETERS, name
+        solver.set_scene_parameters(s, **variation)
+    return ps, solver
+
+
+def run(scene, variations, total_time, output_dir=None, frame_dt=None, verbose=True):
+    # Advance every variation of the scene to t = total_time, stepping all of them in the same kernel launches
+    ps, solver = build_batched_scene(scene, variations)
+    frame_dt = frame_dt or scene['frame_dt']
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    steps = 0
+    # Frames end at fixed times; scenes whose dt does not divide frame_dt stop up to half a step short of them
+    frame_num = int(np.ceil(total_time / frame_dt - 1e-9))
+    start = time.perf_counter()
+    for frame in range(frame_num):
+        t_end = min((frame + 1) * frame_dt, total_time)
+        steps += solver.simulate_until(t_end)
+        if output_dir is not None:
+            data = ps.dump()
+            for s in range(len(variations)):
+                mask = data['scene'] == s
+                np.savez_compressed(os.path.join(output_dir, 'scene_%03d_frame_%05d.npz' % (s, frame)),
+                                    **{name: arr[mask] for name, arr in data.items() if name != 'scene'})
+        if verbose:
+            print('frame %d t %.4f steps %d' % (frame, solver.time, steps))
+    ti.sync()
+    wall = time.perf_counter() - start
+
+    stats = {
+        'scenes': len(variations),
+        'variations': variations,
+        'scene_time': solver.scene_time.tolist(),
+        'frames': frame_num,
+        'steps': steps,
+        'particles': int(ps.particle_num[None]),
+        'wall_time': wall,
+        'steps_per_second': steps / wall,
+    }
+    if output_dir is not None:
+        with open(os.path.join(output_dir, 'stats.json'), 'w') as f:
+            json.dump(stats, f, indent=2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many variations of one WCSPH scene in a single batch')
+    parser.add_argument('variations', help='JSON file with a list of {gravity, viscosity, stiffness, dt} dicts')
+    parser.add_argument('--scene', help='JSON scene config, keys as in headless.DEFAULT_SCENE')
+    parser.add_argument('--arch', default='cpu', choices=['cpu', 'gpu', 'cuda', 'vulkan', 'metal', 'opengl'])
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads (default: all cores)')
+    parser.add_argument('--time', type=float, default=1.0, help='simulated end time in seconds')
+    parser.add_argument('--frame-dt', type=float, default=None, help='simulated time between dumps')
+    parser.add_argument('--output', default=None, help='directory for per-scene frame dumps and stats.json')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
+    init_kwargs = {}
+    if args.threads is not None:
+        init_kwargs['cpu_max_num_threads'] = args.threads
+    ti.init(arch=getattr(ti, args.arch), **init_kwargs)
+
+    with open(args.variations) as f:
+        variations = json.load(f)
+    stats = run(load_scene(args.scene), variations, args.time, args.output, args.frame_dt, verbose=not args.quiet)
+    print('%d scenes, %d steps in %.2f s: %.1f steps/s' % (
+        stats['scenes'], stats['steps'], stats['wall_time'], stats['steps_per_second']))
+
+
+if __name__ == '__main__':
+    main()
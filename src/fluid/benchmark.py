@@ -0,0 +1,198 @@
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import taichi as ti
+
+# Kernels timed one by one, in the order the WCSPH step runs them. build_grid is the whole grid phase: binning,
+# prefix sum, counting sort and permutation.
+KERNELS = ['build_grid', 'search_neighbors', 'compute_densities', 'compute_non_pressure_forces',
+           'compute_pressure_forces', 'advect', 'enforce_boundary']
+DEFAULT_PARTICLE_COUNTS = [4096, 16384, 65536, 262144]
+
+
+def build_benchmark_scene(particle_num, particle_system_kwargs=None, solver_kwargs=None):
+    # A resting cube of roughly particle_num fluid particles in a box with a two-unit margin on every side
+    from particle_system import ParticleSystem
+    from wcsph import WCSPHSolver
+
+    spacing = 0.28  # add_cube samples with particle_radius * 2.8
+    per_axis = int(round(particle_num ** (1.0 / 3.0)))
+    side = per_axis * spacing
+    domain = (side + 4.0,) * 3
+    ps = ParticleSystem(domain, particle_max_num=per_axis ** 3, **(particle_system_kwargs or {}))
+    ps.add_cube(lower_corner=[2.0, 2.0, 2.0], cube_size=[side - 1e-3] * 3, material=ps.material_fluid,
+                velocity=[0.0, 0.0, 0.0], density=1000.0)
+    solver = WCSPHSolver(ps, **(solver_kwargs or {}))
+    return ps, solver
+
+
+def kernel_calls(ps, solver):
+    return {
+        'build_grid': ps.build_grid,
+        'search_neighbors': ps.search_neighbors,
+        'compute_densities': solver.compute_densities,
+        'compute_non_pressure_forces': solver.compute_non_pressure_forces,
+        'compute_pressure_forces': solver.compute_pressure_forces,
+        'advect': solver.advect,
+        'enforce_boundary': solver.enforce_boundary,
+    }
+
+
+# Fields the timed kernels write, restored from a snapshot before every call
+STATE_FIELDS = [('ps', 'x'), ('ps', 'v'), ('ps', 'density'), ('ps', 'pressure'), ('solver', 'd_velocity')]
+
+
+def prepare_state(ps, solver):
+    # A valid grid and neighbor lists, and the densities, pressures and accelerations the later kernels read.
+    # Returns a snapshot of the fields the kernels write.
+    ps.initialize_particle_system()
+    solver.compute_densities()
+    solver.compute_non_pressure_forces()
+    solver.compute_pressure_forces()
+    owners = {'ps': ps, 'solver': solver}
+    return [(getattr(owners[owner], name), getattr(owners[owner], name).to_numpy()) for owner, name in STATE_FIELDS]
+
+
+def restore_state(snapshot):
+    for field, values in snapshot:
+        field.from_numpy(values)
+
+
+def time_call(fn, repeat, setup=None):
+    # Per-call wall times in seconds. ti.sync before and after each call, so asynchronous launches are
+    # charged to the kernel that issued them. setup runs untimed before every call.
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        ti.sync()
+        start = time.perf_counter()
+        fn()
+        ti.sync()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_scene(particle_num, threads, repeat=20, warmup_steps=10, kernels=KERNELS):
+    # One ti.init per thread count; the warm-up steps compile every kernel and let the cube start settling
+    init_kwargs = {}
+    if threads is not None:
+        init_kwargs['cpu_max_num_threads'] = threads
+    ti.init(arch=ti.cpu, **init_kwargs)
+    ps, solver = build_benchmark_scene(particle_num)
+    for _ in range(warmup_steps):
+        solver.step()
+    calls = kernel_calls(ps, solver)
+    results = []
+    for name in kernels:
+        # Every kernel starts from the same valid state; the ones after build_grid would otherwise run on the
+        # stale neighbor lists of a grid it just permuted, and advect would keep moving the particles
+        snapshot = prepare_state(ps, solver)
+        calls[name]()  # the warm-up step skips kernels that are not on its path
+        # Any particle order is a valid input to build_grid, the other kernels are reset to the snapshot
+        setup = None if name == 'build_grid' else (lambda: restore_state(snapshot))
+        times = np.array(time_call(calls[name], repeat, setup))
+        results.append({
+            'kernel': name,
+            'requested_particles': particle_num,
+            'particles': int(ps.particle_num[None]),
+            'threads': threads,
+            'repeat': repeat,
+            'median': float(np.median(times)),
+            'min': float(times.min()),
+            'mean': float(times.mean()),
+            'std': float(times.std()),
+        })
+    return results
+
+
+def run(particle_counts, thread_counts, repeat=20, warmup_steps=10, kernels=KERNELS, verbose=True):
+    results = []
+    for threads in thread_counts:
+        for particle_num in particle_counts:
+            scene_results = benchmark_scene(particle_num, threads, repeat, warmup_steps, kernels)
+            if verbose:
+                for r in scene_results:
+                    print('%-28s particles %8d threads %4s median %9.3f ms min %9.3f ms' % (
+                        r['kernel'], r['particles'], r['threads'], r['median'] * 1e3, r['min'] * 1e3))
+            results.extend(scene_results)
+    return {
+        'meta': {
+            'arch': 'cpu',
+            'taichi': '.'.join(str(v) for v in ti.__version__),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'repeat': repeat,
+            'warmup_steps': warmup_steps,
+        },
+        'results': results,
+    }
+
+
+def result_key(r):
+    return r['kernel'], r['requested_particles'], r['threads']
+
+
+def compare(baseline, current, tolerance=0.1, verbose=True):
+    # Median of every kernel / particle count / thread count present in both files. Returns the entries
+    # that are more than tolerance slower than the baseline.
+    base = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        b = base.get(result_key(r))
+        if b is None:
+            continue
+        ratio = r['median'] / b['median']
+        regressed = ratio > 1.0 + tolerance
+        if verbose:
+            print('%-28s particles %8d threads %4s %9.3f ms -> %9.3f ms  x%.3f%s' % (
+                r['kernel'], r['particles'], r['threads'], b['median'] * 1e3, r['median'] * 1e3, ratio,
+                '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append({'kernel': r['kernel'], 'particles': r['particles'], 'threads': r['threads'],
+                                'baseline': b['median'], 'current': r['median'], 'ratio': ratio})
+    return regressions
+
+
+def parse_int_list(s):
+    return [int(v) for v in s.split(',')] if s else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the SPH pipeline kernels on the CPU backend')
+    parser.add_argument('--particles', default=','.join(str(n) for n in DEFAULT_PARTICLE_COUNTS),
+                        help='comma separated particle counts')
+    parser.add_argument('--threads', default='', help='comma separated CPU thread counts (default: all cores)')
+    parser.add_argument('--kernels', default=','.join(KERNELS), help='comma separated kernels to time')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per kernel')
+    parser.add_argument('--warmup-steps', type=int, default=10, help='solver steps before timing')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='baseline JSON file to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown in --compare')
+    args = parser.parse_args()
+
+    kernels = args.kernels.split(',')
+    for name in kernels:
+        if name not in KERNELS:
+            parser.error('unknown kernel %s' % name)
+    thread_counts = parse_int_list(args.threads) or [None]
+    results = run(parse_int_list(args.particles), thread_counts, args.repeat, args.warmup_steps, kernels)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print('%d regressions above %.0f%%' % (len(regressions), args.tolerance * 100))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import json
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+import taichi as ti
+
+# File layout: MAGIC, u32 format version, u32 header size, JSON header, then one block per array. Blocks start
+# at ALIGNMENT-byte offsets recorded in the header, so every array can be memory-mapped in place on load.
+MAGIC = b'SPHCKPT\0'
+VERSION = 1
+ALIGNMENT = 64
+
+# Checkpointed name -> ParticleSystem attribute
+PARTICLE_FIELDS = {
+    'position': 'x',
+    'velocity': 'v',
+    'density': 'density',
+    'pressure': 'pressure',
+    'material': 'material',
+    'color': 'color',
+    'scene': 'scene_id',
+    'id': 'particle_id',
+}
+
+
+def _is_vector(field):
+    return isinstance(field, ti.MatrixField)
+
+
+def _checkpoint_fields(ps):
+    # Solver state kept across steps (e.g. the DFSPH warm start) is registered as sorted fields
+    fields = {name: getattr(ps, attr) for name, attr in PARTICLE_FIELDS.items()}
+    for i, (field, _) in enumerate(ps.sorted_fields):
+        fields['sorted_%d' % i] = field
+    return fields
+
+
+def snapshot(ps, solver):
+    # Copy the state to host memory, returns (header, arrays) for write_checkpoint
+    n = ps.particle_num[None]
+    arrays = {}
+    for name, field in _checkpoint_fields(ps).items():
+        dtype = ti.lang.util.to_numpy_type(field.dtype)
+        if _is_vector(field):
+            arr = np.empty((n, field.n), dtype=dtype)
+            ps.copy_to_numpy_nd(arr, field)
+        else:
+            arr = np.empty(n, dtype=dtype)
+            ps.copy_to_numpy(arr, field)
+        arrays[name] = arr
+    if ps.boundary_max_num > 0:
+        arrays['boundary_position'] = ps.boundary_x.to_numpy()[:ps.boundary_num[None]]
+    header = {
+        'version': VERSION,
+        'dim': ps.dim,
+        'particle_num': n,
+        'solver': type(solver).__name__,
+        'time': solver.time,
+        'dt': float(solver.dt[None]),
+        'next_particle_id': ps.next_particle_id,
+    }
+    if ps.scene_num > 1:
+        # Batched scenes advance with their own dt, see SPHBase.simulate_scenes_until
+        header['scene_time'] = solver.scene_time.tolist()
+    return header, arrays
+
+
+def write_checkpoint(path, header, arrays):
+    # Written to a temporary file first, so an interrupted write never replaces the last good checkpoint
+    header = dict(header)
+    header['arrays'] = {}
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += -(-arr.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<II', VERSION, len(header_bytes)) + header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(memoryview(np.ascontiguousarray(arr)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path, mmap=True):
+    # Returns (header, arrays); with mmap=True the arrays are read-only views into the file
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an SPH checkpoint' % path)
+        version, header_size = struct.unpack('<II', f.read(8))
+        if version > VERSION:
+            raise ValueError('checkpoint version %d is newer than supported version %d' % (version, VERSION))
+        header = json.loads(f.read(header_size))
+        data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+        arrays = {}
+        for name, info in header['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            shape = tuple(info['shape'])
+            if mmap and int(np.prod(shape)) > 0:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + info['offset'], shape=shape)
+            else:
+                f.seek(data_start + info['offset'])
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return header, arrays
+
+
+def save_checkpoint(ps, solver, path):
+    header, arrays = snapshot(ps, solver)
+    write_checkpoint(path, header, arrays)
+
+
+def load_checkpoint(ps, solver, path, mmap=True):
+    # Restore a checkpoint into an already constructed ParticleSystem and solver of the same configuration
+    header, arrays = read_checkpoint(path, mmap)
+    n = header['particle_num']
+    if header['dim'] != ps.dim:
+        raise ValueError('checkpoint is %dD, particle system is %dD' % (header['dim'], ps.dim))
+    if n > ps.particle_max_num:
+        raise ValueError('checkpoint holds %d particles, particle_max_num is %d' % (n, ps.particle_max_num))
+    ps.particle_num[None] = n
+    ps.next_particle_id = header.get('next_particle_id', n)
+    for name, field in _checkpoint_fields(ps).items():
+        if name not in arrays:
+            if name.startswith('sorted_') or name == 'scene':
+                field.fill(0)
+                continue
+            if name == 'id':
+                # Written before particles had ids
+                if n > 0:
+                    ps.copy_from_numpy(field, np.arange(n, dtype=np.int32))
+                continue
+            raise ValueError('checkpoint has no %s' % name)
+        if n == 0:
+            continue
+        # The cast also turns the memory map into the contiguous array the copy kernel needs
+        arr = np.ascontiguousarray(arrays[name], dtype=ti.lang.util.to_numpy_type(field.dtype))
+        if _is_vector(field):
+            ps.copy_from_numpy_nd(field, arr)
+        else:
+            ps.copy_from_numpy(field, arr)
+    if 'boundary_position' in arrays and ps.boundary_max_num > 0:
+        ps.boundary_num[None] = 0
+        ps.add_boundary_from_numpy(arrays['boundary_position'])
+    # Grid and neighbor lists are rebuilt from the restored positions on the next step
+    ps.built_particle_num = -1
+    solver.time = header['time']
+    solver.dt[None] = header['dt']
+    if ps.scene_num > 1:
+        solver.scene_time = np.array(header.get('scene_time', [header['time']] * ps.scene_num), dtype=np.float64)
+    return header
+
+
+class CheckpointWriter:
+    # Periodic checkpoints written by a background thread. The state is copied on the calling thread, so it is
+    # consistent; only the file write overlaps with the simulation. The last `keep` checkpoints are kept.
+    def __init__(self, ps, solver, directory, interval, keep=2):
+        self.ps = ps
+        self.solver = solver
+        self.directory = directory
+        self.interval = interval  # simulated seconds between checkpoints
+        self.keep = keep
+        self.next_time = solver.time + interval
+        # Checkpoints left by an earlier run in the same directory count towards keep
+        self.paths = [os.path.join(directory, p) for p in _checkpoint_names(directory)]
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+        # One checkpoint may be in flight, a second request waits for it
+        self.pending = queue.Queue(maxsize=1)
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def maybe_save(self):
+        # Call once per step or frame, saves when the interval has elapsed
+        if self.solver.time + 1e-9 >= self.next_time:
+            self.save()
+            while self.next_time <= self.solver.time + 1e-9:
+                self.next_time += self.interval
+            return True
+        return False
+
+    def save(self):
+        if self.error is not None:
+            raise self.error
+        header, arrays = snapshot(self.ps, self.solver)
+        path = os.path.join(self.directory, 'checkpoint_%012.6f.ckpt' % self.solver.time)
+        self.pending.put((path, header, arrays))
+
+    def _writer_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            path, header, arrays = item
+            try:
+                write_checkpoint(path, header, arrays)
+                self.paths.append(path)
+                while len(self.paths) > self.keep:
+                    os.remove(self.paths.pop(0))
+            except Exception as e:
+                self.error = e
+
+    def latest(self):
+        return self.paths[-1] if self.paths else None
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _checkpoint_names(directory):
+    # Complete checkpoints in directory, oldest first
+    if not os.path.isdir(directory):
+        return []
+    return sorted(p for p in os.listdir(directory) if p.endswith('.ckpt'))
+
+
+def latest_checkpoint(directory):
+    # Most recent complete checkpoint in directory, or None
+    names = _checkpoint_names(directory)
+    return os.path.join(directory, names[-1]) if names else None
@@ -109,7 +109,7 @@ if __name__ == "__main__":
     x_max = 4 * kk
     y_max = 9 * kk
     z_max = 4 * kk
-    ps = ParticleSystem((x_max, y_max, z_max))
+    ps = ParticleSystem((x_max, y_max, z_max), skin=0.1, single_precision=True)
 
     ps.add_cube(lower_corner=[1 * kk, 1 * kk, 1 * kk],
                 cube_size=[2 * kk, 6 * kk, 2 * kk],
@@ -125,7 +125,8 @@ if __name__ == "__main__":
     #             color=0x956333,
     #             material=1)
 
-    wcsph_solver = WCSPHSolver(ps)
+    wcsph_solver = WCSPHSolver(ps, adaptive_dt=True, fused=True)
+    frame_dt = 5e-3  # simulated time per frame
 
     floors, indices, colors = init_scene()
 
@@ -189,9 +190,7 @@ if __name__ == "__main__":
         # if window.is_pressed('r'):
         # particleSystem.initialize_mass_points()
 
-        for i in range(25):
-            wcsph_solver.step()
-        particle_info = ps.dump()
+        wcsph_solver.simulate_until(wcsph_solver.time + frame_dt)
 
         scene.point_light(pos=(30, 30, 30), color=(255 / 255.0, 198 / 255.0, 107 / 255.0))
         scene.ambient_light((0.5, 0.5, 0.5))
@@ -0,0 +1,247 @@
+import taichi as ti
+from sph_base import SPHBase
+
+
+class DFSPHSolver(SPHBase):
+    # Divergence-free SPH (Bender & Koschier 2015). Densities are handled as ratios to density_0
+    # and pressures as kappa = p / density_0, so the solves are independent of the fluid's units.
+    def __init__(self, particle_system, **kwargs):
+        super().__init__(particle_system, **kwargs)
+        assert self.scene_num == 1, 'DFSPHSolver does not support batched scenes'
+        self.enable_divergence_solver = True
+        self.warm_start = True
+        self.max_iterations = 100
+        self.max_iterations_v = 100
+        self.max_error = 0.05  # allowed average density error in percent
+        self.max_error_V = 0.1  # allowed average divergence error in percent per second
+        self.eps = 1e-5
+
+        self.factor = ti.field(float)
+        self.density_adv = ti.field(float)
+        self.kappa = ti.field(float)  # accumulated pressure of the last step, used for warm starting
+        self.kappa_v = ti.field(float)  # same for the divergence solve
+        self.kappa_iter = ti.field(float)  # pressure applied in the current iteration
+        self.ps.place_particle_fields(self.factor, self.density_adv, self.kappa, self.kappa_v, self.kappa_iter)
+        self.ps.register_sorted_field(self.kappa)
+        self.ps.register_sorted_field(self.kappa_v)
+
+        # Convergence statistics of the last step
+        self.pressure_iterations = 0
+        self.density_error = 0.0
+        self.divergence_iterations = 0
+        self.divergence_error = 0.0
+
+    @ti.func
+    def compute_densities_task(self, p_i, p_j, ret: ti.template()):
+        x_i = self.ps.x[p_i]
+        x_j = self.ps.x[p_j]
+        ret += self.ps.m_V * self.cubic_kernel((x_i - x_j).norm())
+
+    @ti.func
+    def compute_boundary_densities_task(self, p_i, b, ret: ti.template()):
+        ret += self.ps.boundary_volume[b] * self.cubic_kernel((self.ps.x[p_i] - self.ps.boundary_x[b]).norm())
+
+    @ti.kernel
+    def compute_densities(self):
+        for p_i in range(self.ps.particle_num[None]):
+            density = self.ps.m_V * self.cubic_kernel(0.0)
+            self.ps.for_all_neighbors(p_i, self.compute_densities_task, density)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_densities_task, density)
+            self.ps.density[p_i] = density * self.density_0
+
+    @ti.func
+    def compute_factor_task(self, p_i, p_j, ret: ti.template()):
+        # ret[:dim] accumulates the gradient sum, ret[dim] the sum of squared gradients
+        grad_p_j = self.ps.m_V * self.cubic_kernel_derivative(self.ps.x[p_i] - self.ps.x[p_j])
+        for d in ti.static(range(self.ps.dim)):
+            ret[d] += grad_p_j[d]
+        ret[self.ps.dim] += grad_p_j.norm_sqr()
+
+    @ti.func
+    def compute_boundary_factor_task(self, p_i, b, ret: ti.template()):
+        # Boundary samples do not move, so they only enter the gradient sum
+        grad_b = self.ps.boundary_volume[b] * self.cubic_kernel_derivative(self.ps.x[p_i] - self.ps.boundary_x[b])
+        for d in ti.static(range(self.ps.dim)):
+            ret[d] += grad_b[d]
+
+    @ti.kernel
+    def compute_factor(self):
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            ret = ti.Vector([0.0 for _ in range(self.ps.dim + 1)])
+            self.ps.for_all_neighbors(p_i, self.compute_factor_task, ret)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_factor_task, ret)
+            grad_sum = ti.Vector([ret[d] for d in ti.static(range(self.ps.dim))])
+            sum_grad = grad_sum.norm_sqr() + ret[self.ps.dim]
+            factor = 0.0
+            if sum_grad > self.eps:
+                factor = 1.0 / sum_grad
+            self.factor[p_i] = factor
+
+    @ti.func
+    def compute_density_change_task(self, p_i, p_j, ret: ti.template()):
+        v_ij = self.ps.v[p_i] - self.ps.v[p_j]
+        ret += self.ps.m_V * v_ij.dot(self.cubic_kernel_derivative(self.ps.x[p_i] - self.ps.x[p_j]))
+
+    @ti.func
+    def compute_boundary_density_change_task(self, p_i, b, ret: ti.template()):
+        ret += self.ps.boundary_volume[b] * self.ps.v[p_i].dot(
+            self.cubic_kernel_derivative(self.ps.x[p_i] - self.ps.boundary_x[b]))
+
+    @ti.kernel
+    def compute_density_change(self):
+        # Divergence error, only compression is corrected and only where the fluid is at rest density
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            density_change = 0.0
+            if self.ps.density[p_i] >= self.density_0:
+                self.ps.for_all_neighbors(p_i, self.compute_density_change_task, density_change)
+                self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_density_change_task, density_change)
+            self.density_adv[p_i] = ti.max(density_change, 0.0)
+
+    @ti.kernel
+    def compute_density_adv(self):
+        # Predicted density ratio after advecting with the current velocities
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            delta = 0.0
+            self.ps.for_all_neighbors(p_i, self.compute_density_change_task, delta)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_density_change_task, delta)
+            density_adv = self.ps.density[p_i] / self.density_0 + self.dt[None] * delta
+            self.density_adv[p_i] = ti.max(density_adv, 1.0)
+
+    @ti.kernel
+    def compute_average_error(self, offset: float) -> float:
+        error = 0.0
+        fluid_num = 0
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] == self.ps.material_fluid:
+                error += self.density_adv[p_i] - offset
+                fluid_num += 1
+        return error / ti.max(fluid_num, 1)
+
+    @ti.kernel
+    def update_kappa(self, kappa: ti.template(), offset: float, scale: float):
+        # kappa_i = error_i * factor_i * scale, summed into kappa for the next warm start
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            k_i = (self.density_adv[p_i] - offset) * self.factor[p_i] * scale
+            self.kappa_iter[p_i] = k_i
+            kappa[p_i] += k_i
+
+    @ti.kernel
+    def load_warm_start(self, kappa: ti.template(), offset: float):
+        # Reuse half of last step's pressure, only where the constraint is violated again
+        for p_i in range(self.ps.particle_num[None]):
+            k_i = 0.0
+            if self.density_adv[p_i] > offset:
+                k_i = 0.5 * ti.max(kappa[p_i], 0.0)
+            self.kappa_iter[p_i] = k_i
+            kappa[p_i] = k_i
+
+    @ti.func
+    def pressure_correction_task(self, p_i, p_j, ret: ti.template()):
+        k_sum = self.kappa_iter[p_i] + self.kappa_iter[p_j]
+        ret += self.ps.m_V * k_sum * self.cubic_kernel_derivative(self.ps.x[p_i] - self.ps.x[p_j])
+
+    @ti.func
+    def boundary_pressure_correction_task(self, p_i, b, ret: ti.template()):
+        ret += self.ps.boundary_volume[b] * self.kappa_iter[p_i] * \
+            self.cubic_kernel_derivative(self.ps.x[p_i] - self.ps.boundary_x[b])
+
+    @ti.kernel
+    def apply_pressure_correction(self):
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
+            self.ps.for_all_neighbors(p_i, self.pressure_correction_task, d_v)
+            self.ps.for_all_boundary_neighbors(p_i, self.boundary_pressure_correction_task, d_v)
+            self.ps.v[p_i] -= self.dt[None] * d_v
+
+    def divergence_solve(self):
+        if self.warm_start:
+            self.compute_density_change()
+            self.load_warm_start(self.kappa_v, 0.0)
+            self.apply_pressure_correction()
+        else:
+            self.kappa_v.fill(0.0)
+        dt = self.dt[None]
+        eta = self.max_error_V * 0.01 / dt
+        iteration = 0
+        error = 0.0
+        while iteration < self.max_iterations_v:
+            self.compute_density_change()
+            error = self.compute_average_error(0.0)
+            if iteration > 0 and error <= eta:
+                break
+            self.update_kappa(self.kappa_v, 0.0, 1.0 / dt)
+            self.apply_pressure_correction()
+            iteration += 1
+        self.divergence_iterations = iteration
+        self.divergence_error = error
+
+    def pressure_solve(self):
+        if self.warm_start:
+            self.compute_density_adv()
+            self.load_warm_start(self.kappa, 1.0)
+            self.apply_pressure_correction()
+        else:
+            self.kappa.fill(0.0)
+        dt = self.dt[None]
+        eta = self.max_error * 0.01
+        iteration = 0
+        error = 0.0
+        while iteration < self.max_iterations:
+            self.compute_density_adv()
+            error = self.compute_average_error(1.0)
+            if iteration > 0 and error <= eta:
+                break
+            self.update_kappa(self.kappa, 1.0, 1.0 / dt ** 2)
+            self.apply_pressure_correction()
+            iteration += 1
+        self.pressure_iterations = iteration
+        self.density_error = error
+
+    @ti.func
+    def compute_non_pressure_forces_task(self, p_i, p_j, ret: ti.template()):
+        x_i = self.ps.x[p_i]
+        x_j = self.ps.x[p_j]
+        ret += self.viscosity_force(p_i, p_j, x_i - x_j)
+
+    @ti.kernel
+    def compute_non_pressure_forces(self):
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            # Add body force
+            d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
+            d_v[1] = self.g  # Y轴
+            self.ps.for_all_neighbors(p_i, self.compute_non_pressure_forces_task, d_v)
+            self.d_velocity[p_i] = d_v
+
+    @ti.kernel
+    def predict_velocity(self):
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] == self.ps.material_fluid:
+                self.ps.v[p_i] += self.dt[None] * self.d_velocity[p_i]
+
+    @ti.kernel
+    def advect(self):
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] == self.ps.material_fluid:
+                self.ps.x[p_i] += self.dt[None] * self.ps.v[p_i]
+
+    def substep(self):
+        self.run_phase('compute_densities', self.compute_densities)
+        self.run_phase('compute_factor', self.compute_factor)
+        if self.enable_divergence_solver:
+            self.run_phase('divergence_solve', self.divergence_solve)
+        self.run_phase('compute_non_pressure_forces', self.compute_non_pressure_forces)
+        self.run_phase('predict_velocity', self.predict_velocity)
+        self.run_phase('pressure_solve', self.pressure_solve)
+        self.run_phase('advect', self.advect)
@@ -0,0 +1,363 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import taichi as ti
+
+from headless import load_scene
+from profiler import StepHook
+
+# ParticleSystem.particle_radius, for sizing a rank before its ParticleSystem exists
+PARTICLE_RADIUS = 0.1
+
+# ParticleSystem fields moved between ranks -> whether they are vector fields. Ghost values are matched to
+# the particles they copy by particle_id.
+STATE_FIELDS = {
+    'x': True,
+    'v': True,
+    'density': False,
+    'pressure': False,
+    'material': False,
+    'color': False,
+    'particle_id': False,
+}
+
+
+class Transport:
+    # Point-to-point messages between the ranks of one run. exchange must be deadlock free when every rank
+    # walks its peers in ascending order, e.g. the lower rank sends first and the higher one receives first.
+    rank = 0
+    size = 1
+
+    def exchange(self, peer, obj):
+        raise NotImplementedError
+
+    def all_to_all(self, objs):
+        # objs[q] goes to rank q, returns what every rank sent to this one
+        res = [None] * self.size
+        res[self.rank] = objs[self.rank]
+        for peer in range(self.size):
+            if peer != self.rank:
+                res[peer] = self.exchange(peer, objs[peer])
+        return res
+
+    def all_gather(self, obj):
+        return self.all_to_all([obj] * self.size)
+
+    def close(self):
+        pass
+
+
+class PipeTransport(Transport):
+    # Reference transport for ranks on one machine: a full mesh of multiprocessing pipes (Unix socket pairs)
+    def __init__(self, rank, size, connections):
+        self.rank = rank
+        self.size = size
+        self.connections = connections  # peer -> Connection
+
+    @staticmethod
+    def create(size):
+        # Connections for every rank, pass entry r to the process of rank r
+        connections = [{} for _ in range(size)]
+        for a in range(size):
+            for b in range(a + 1, size):
+                connections[a][b], connections[b][a] = multiprocessing.Pipe()
+        return connections
+
+    def exchange(self, peer, obj):
+        conn = self.connections[peer]
+        if self.rank < peer:
+            conn.send(obj)
+            return conn.recv()
+        res = conn.recv()
+        conn.send(obj)
+        return res
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+
+
+class DistributedRank(StepHook):
+    # One slab of a domain split along axis. The rank owns the particles inside [cuts[rank], cuts[rank + 1])
+    # and keeps copies of the other ranks' particles within one support radius of its slab as ghosts. Each
+    # step, as a solver hook: particles that left the slab migrate to their new owner and the ghosts are
+    # refreshed (begin_step), then ghost densities and pressures are copied from their owners once the owners
+    # have computed them (end of the density phase). Ghosts of fluid particles are stored with material_ghost,
+    # so they take part in the sums without being advected.
+    def __init__(self, ps, solver, transport, axis=0, rebalance_interval=100, rebalance_bins=1024):
+        assert ps.scene_num == 1
+        self.ps = ps
+        self.solver = solver
+        self.transport = transport
+        self.rank = transport.rank
+        self.size = transport.size
+        self.axis = axis
+        self.halo = ps.support_radius
+        self.rebalance_interval = rebalance_interval
+        self.rebalance_bins = rebalance_bins
+        self.material_ghost = ps.material_fluid + 1
+        self.step_num = 0
+
+        self.ghost_sent = [np.empty(0, dtype=np.int32) for _ in range(self.size)]
+        self.ghost_ids = np.empty(0, dtype=np.int32)
+        self.owned_num = 0
+        self.ghost_num = 0
+        # The ranks agree on a common dt in global_dt instead of each computing its own
+        self.adaptive_dt = solver.adaptive_dt
+        self.dt = float(solver.dt[None])
+        solver.adaptive_dt = False
+
+        self.cuts = slab_edges(ps.bound[axis], self.size)
+        solver.add_hook(self)
+
+    def read_state(self):
+        n = self.ps.particle_num[None]
+        state = {}
+        for name, vector in STATE_FIELDS.items():
+            field = getattr(self.ps, name)
+            dtype = ti.lang.util.to_numpy_type(field.dtype)
+            if vector:
+                arr = np.empty((n, self.ps.dim), dtype=dtype)
+                self.ps.copy_to_numpy_nd(arr, field)
+            else:
+                arr = np.empty(n, dtype=dtype)
+                self.ps.copy_to_numpy(arr, field)
+            state[name] = arr
+        return state
+
+    def write_state(self, state):
+        n = len(state['particle_id'])
+        assert n <= self.ps.particle_max_num, 'rank %d needs %d particles' % (self.rank, n)
+        self.ps.particle_num[None] = n
+        if n == 0:
+            return
+        for name, vector in STATE_FIELDS.items():
+            field = getattr(self.ps, name)
+            arr = np.ascontiguousarray(state[name], dtype=ti.lang.util.to_numpy_type(field.dtype))
+            if vector:
+                self.ps.copy_from_numpy_nd(field, arr)
+            else:
+                self.ps.copy_from_numpy(field, arr)
+        # Positions were replaced wholesale, the grid has to be rebuilt
+        self.ps.built_particle_num = -1
+
+    def initialize(self):
+        # Keep only the own slab, in case the rank was built from the full scene, and collect the ghosts
+        state = self.read_state()
+        self.write_state(select(state, self.owner(state['x']) == self.rank))
+        self.exchange_particles(self.read_state())
+
+    def owner(self, x):
+        return np.clip(np.searchsorted(self.cuts, x[:, self.axis], side='right') - 1, 0, self.size - 1)
+
+    def owned_state(self):
+        state = self.read_state()
+        return select(state, ~np.isin(state['particle_id'], self.ghost_ids))
+
+    def rebalance(self, state):
+        # New cuts at the quantiles of the particle positions along axis, from a histogram all ranks share
+        lo, hi = 0.0, float(self.ps.bound[self.axis])
+        hist, _ = np.histogram(np.clip(state['x'][:, self.axis], lo, hi), bins=self.rebalance_bins, range=(lo, hi))
+        total = np.sum(self.transport.all_gather(hist), axis=0)
+        cdf = np.cumsum(total)
+        if cdf[-1] == 0:
+            return
+        edges = np.linspace(lo, hi, self.rebalance_bins + 1)
+        targets = cdf[-1] * np.arange(1, self.size) / self.size
+        cuts = edges[1:][np.searchsorted(cdf, targets)]
+        self.cuts = np.concatenate([[-np.inf], cuts, [np.inf]])
+
+    def exchange_particles(self, state):
+        # state: the particles this rank owned after the last step. Sends leavers to their new owners and
+        # ghosts to every rank whose slab is within halo, then writes owned particles followed by ghosts.
+        owner = self.owner(state['x'])
+        received = self.transport.all_to_all([select(state, owner == q) for q in range(self.size)])
+        owned = concat(received)
+        pos = owned['x'][:, self.axis]
+        ghosts_out = []
+        for q in range(self.size):
+            if q == self.rank:
+                ghosts_out.append(select(owned, np.zeros(len(pos), dtype=bool)))
+                continue
+            near = (pos >= self.cuts[q] - self.halo) & (pos < self.cuts[q + 1] + self.halo)
+            ghosts_out.append(select(owned, near))
+        self.ghost_sent = [g['particle_id'] for g in ghosts_out]
+        ghosts = concat(self.transport.all_to_all(ghosts_out))
+        ghosts['material'] = np.where(ghosts['material'] == self.ps.material_fluid, self.material_ghost,
+                                      ghosts['material']).astype(ghosts['material'].dtype)
+        self.ghost_ids = ghosts['particle_id']
+        self.ghost_num = len(ghosts['particle_id'])
+        self.owned_num = len(owned['particle_id'])
+        self.write_state(concat([owned, ghosts]))
+
+    def exchange_ghost_values(self):
+        # Owners send the densities and pressures of the particles other ranks hold as ghosts
+        n = self.ps.particle_num[None]
+        gid = np.empty(n, dtype=np.int32)
+        self.ps.copy_to_numpy(gid, self.ps.particle_id)
+        dtype = ti.lang.util.to_numpy_type(self.ps.density.dtype)
+        density = np.empty(n, dtype=dtype)
+        pressure = np.empty(n, dtype=dtype)
+        self.ps.copy_to_numpy(density, self.ps.density)
+        self.ps.copy_to_numpy(pressure, self.ps.pressure)
+        order = np.argsort(gid)
+        sorted_gid = gid[order]
+
+        def index(ids):
+            return order[np.searchsorted(sorted_gid, ids)]
+
+        out = []
+        for q in range(self.size):
+            i = index(self.ghost_sent[q]) if q != self.rank else np.empty(0, dtype=np.int64)
+            out.append((self.ghost_sent[q], density[i], pressure[i]))
+        for ids, d, p in self.transport.all_to_all(out):
+            if len(ids):
+                i = index(ids)
+                density[i] = d
+                pressure[i] = p
+        self.ps.copy_from_numpy(self.ps.density, density)
+        self.ps.copy_from_numpy(self.ps.pressure, pressure)
+
+    def begin_step(self, solver):
+        state = self.owned_state()
+        if self.rebalance_interval > 0 and self.step_num > 0 and self.step_num % self.rebalance_interval == 0:
+            self.rebalance(state)
+        self.exchange_particles(state)
+        self.step_num += 1
+
+    def end_phase(self, solver, name):
+        if name in ('compute_densities', 'compute_densities_and_pressure'):
+            self.exchange_ghost_values()
+
+    def global_dt(self, t_end):
+        # Every rank has to take the same step
+        dt = self.solver.compute_cfl_dt() if self.adaptive_dt else self.dt
+        return min(min(self.transport.all_gather(dt)), t_end - self.solver.time)
+
+
+def slab_edges(length, size):
+    # Equal slabs to start with, the outer ones open ended
+    edges = np.linspace(0.0, length, size + 1)
+    edges[0], edges[-1] = -np.inf, np.inf
+    return edges
+
+
+def build_rank_scene(scene, rank, size, axis=0):
+    # headless.build_scene for one rank: the ParticleSystem is sized for the rank's initial slab and halo, and
+    # only the particles of the slab are spawned, with the ids they have in the full scene
+    from particle_system import ParticleSystem, cube_positions, sphere_positions
+    from wcsph import WCSPHSolver
+
+    edges = slab_edges(scene['domain'][axis], size)
+    ps_kwargs = dict(scene['particle_system'])
+    if 'particle_max_num' not in ps_kwargs:
+        spacing = PARTICLE_RADIUS * 2.8
+        halo = PARTICLE_RADIUS * 4.5
+        x = np.concatenate([cube_positions(c['lower_corner'], c['cube_size'], spacing)[:, axis]
+                            for c in scene['cubes']] +
+                           [sphere_positions(s['center'], s['radius'], spacing)[:, axis] for s in scene['spheres']] +
+                           [np.empty(0)])
+        local = np.count_nonzero((x >= edges[rank] - halo) & (x < edges[rank + 1] + halo))
+        # Room for the particles migration and rebalancing bring in
+        ps_kwargs['particle_max_num'] = max(int(2 * max(local, len(x) / size)), 1)
+    ps = ParticleSystem(tuple(scene['domain']), **ps_kwargs)
+    ps.spawn_region = (axis, edges[rank], edges[rank + 1])
+    for cube in scene['cubes']:
+        ps.add_cube(**cube)
+    for sphere in scene['spheres']:
+        ps.add_sphere(**sphere)
+    for box in scene['boundary_boxes']:
+        ps.add_boundary_box(**box)
+    ps.spawn_region = None
+    solver = WCSPHSolver(ps, **scene['solver'])
+    return ps, solver
+
+
+def select(state, mask):
+    return {name: arr[mask] for name, arr in state.items()}
+
+
+def concat(states):
+    return {name: np.concatenate([s[name] for s in states]) for name in states[0]}
+
+
+def rank_main(rank, size, connections, scene, total_time, frame_dt, output_dir, threads, axis, rebalance_interval,
+              results):
+    init_kwargs = {}
+    if threads is not None:
+        init_kwargs['cpu_max_num_threads'] = threads
+    ti.init(arch=ti.cpu, **init_kwargs)
+    transport = PipeTransport(rank, size, connections)
+    ps, solver = build_rank_scene(scene, rank, size, axis)
+    dist = DistributedRank(ps, solver, transport, axis=axis, rebalance_interval=rebalance_interval)
+    dist.initialize()
+    frame_dt = frame_dt or scene['frame_dt']
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    steps = 0
+    frame = 0
+    start = time.perf_counter()
+    while solver.time < total_time - 1e-9:
+        t_end = min(solver.time + frame_dt, total_time)
+        while solver.time < t_end - 1e-9:
+            solver.dt[None] = dist.global_dt(t_end)
+            solver.step()
+            steps += 1
+        if output_dir is not None:
+            state = dist.owned_state()
+            np.savez_compressed(os.path.join(output_dir, 'rank_%02d_frame_%05d.npz' % (rank, frame)),
+                                position=state['x'], velocity=state['v'], material=state['material'],
+                                color=state['color'], id=state['particle_id'])
+        frame += 1
+    ti.sync()
+    results.put({'rank': rank, 'steps': steps, 'frames': frame, 'owned': dist.owned_num, 'ghosts': dist.ghost_num,
+                 'cuts': [float(c) for c in dist.cuts[1:-1]], 'wall_time': time.perf_counter() - start})
+    transport.close()
+
+
+def run(scene, size, total_time, output_dir=None, frame_dt=None, threads_per_rank=None, axis=0,
+        rebalance_interval=100):
+    ctx = multiprocessing.get_context('spawn')
+    connections = PipeTransport.create(size)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=rank_main, args=(r, size, connections[r], scene, total_time, frame_dt, output_dir,
+                                                 threads_per_rank, axis, rebalance_interval, results))
+             for r in range(size)]
+    for p in procs:
+        p.start()
+    stats = sorted((results.get() for _ in procs), key=lambda s: s['rank'])
+    for p in procs:
+        p.join()
+    if output_dir is not None:
+        with open(os.path.join(output_dir, 'stats.json'), 'w') as f:
+            json.dump(stats, f, indent=2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the WCSPH solver split into slabs over several processes')
+    parser.add_argument('--scene', help='JSON scene config, keys as in headless.DEFAULT_SCENE')
+    parser.add_argument('--ranks', type=int, default=2, help='number of processes')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per rank (default: cores / ranks)')
+    parser.add_argument('--axis', type=int, default=0, help='axis the domain is split along')
+    parser.add_argument('--rebalance', type=int, default=100, help='steps between load balancing, 0 to disable')
+    parser.add_argument('--time', type=float, default=1.0, help='simulated end time in seconds')
+    parser.add_argument('--frame-dt', type=float, default=None, help='simulated time between dumps')
+    parser.add_argument('--output', default=None, help='directory for per-rank frame dumps and stats.json')
+    args = parser.parse_args()
+
+    threads = args.threads or max(os.cpu_count() // args.ranks, 1)
+    stats = run(load_scene(args.scene), args.ranks, args.time, args.output, args.frame_dt, threads, args.axis,
+                args.rebalance)
+    for s in stats:
+        print('rank %d: %d steps in %.2f s, %d owned, %d ghosts' % (s['rank'], s['steps'], s['wall_time'],
+                                                                      s['owned'], s['ghosts']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class InflowEmitter:
+    # Continuous inflow through a circular (2D: line) nozzle. A layer of particles is injected every
+    # time the previous layer has moved one particle spacing away from the nozzle.
+    def __init__(self, particle_system, center, direction, radius, speed, material,
+                 color=0xFFFFFF, density=None):
+        self.ps = particle_system
+        self.center = np.asarray(center, dtype=np.float32)
+        self.direction = np.asarray(direction, dtype=np.float32)
+        self.direction /= np.linalg.norm(self.direction)
+        self.speed = speed
+        self.material = material
+        self.color = color
+        self.density = density
+        self.spacing = self.ps.particle_radius * 2.8
+        self.enabled = True
+
+        # Offsets of one layer in the nozzle plane, computed once
+        ticks = np.arange(-radius, radius + 1e-6, self.spacing)
+        if self.ps.dim == 2:
+            tangent = np.array([-self.direction[1], self.direction[0]], dtype=np.float32)
+            offsets = ticks[:, None] * tangent
+        else:
+            helper = np.array([1.0, 0.0, 0.0]) if abs(self.direction[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+            tangent_u = np.cross(self.direction, helper)
+            tangent_u /= np.linalg.norm(tangent_u)
+            tangent_v = np.cross(self.direction, tangent_u)
+            u, v = np.meshgrid(ticks, ticks, indexing='ij')
+            inside = u ** 2 + v ** 2 <= radius ** 2
+            offsets = u[inside][:, None] * tangent_u + v[inside][:, None] * tangent_v
+        self.layer = (self.center + offsets).astype(np.float32)
+        self.velocity = self.direction * self.speed
+        # Emit the first layer on the first call
+        self.distance = self.spacing
+
+    def emit(self, dt):
+        # Call once per step with the step's dt, returns the number of particles added
+        if not self.enabled:
+            return 0
+        self.distance += self.speed * dt
+        added = 0
+        while self.distance >= self.spacing:
+            self.distance -= self.spacing
+            if self.ps.particle_num[None] + len(self.layer) > self.ps.particle_max_num:
+                self.enabled = False
+                break
+            # The layer has already travelled self.distance past the nozzle
+            positions = self.layer + self.direction * self.distance
+            self.ps.add_particles_from_numpy(positions, self.material, self.color, self.density,
+                                             velocity=self.velocity)
+            added += len(self.layer)
+        return added
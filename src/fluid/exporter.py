@@ -0,0 +1,201 @@
+import json
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+import taichi as ti
+
+# Exported name -> ParticleSystem attribute
+EXPORT_FIELDS = {
+    'position': 'x',
+    'velocity': 'v',
+    'density': 'density',
+    'pressure': 'pressure',
+    'material': 'material',
+    'color': 'color',
+    'scene': 'scene_id',
+    'id': 'particle_id',
+}
+
+RAW_MAGIC = b'SPHF'
+
+
+class FrameExporter:
+    # Streams particle frames to disk from a background thread. Frames are copied into a small pool of
+    # preallocated host buffers (two by default) and handed to the writer through a bounded queue, so the
+    # simulation only waits when the writer has fallen a whole pool behind, and never allocates in steady state.
+    #   format='npz': one compressed frame_#####.npz per frame
+    #   format='raw': frames appended to chunk_####.bin files, frames_per_chunk frames each, see read_raw_chunk
+    def __init__(self, particle_system, output_dir, fields=('position', 'velocity', 'material', 'color'),
+                 format='npz', num_buffers=2, frames_per_chunk=64, block=True, first_frame=0):
+        assert format in ('npz', 'raw')
+        for name in fields:
+            assert name in EXPORT_FIELDS, name
+        self.ps = particle_system
+        self.output_dir = output_dir
+        self.fields = tuple(fields)
+        self.format = format
+        self.frames_per_chunk = frames_per_chunk
+        # With block=False a frame is dropped instead of waiting for a free buffer
+        self.block = block
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.capacity = 0
+        self.buffers = [{} for _ in range(num_buffers)]
+        self.free_buffers = queue.Queue()
+        for buffer in self.buffers:
+            self.free_buffers.put(buffer)
+        self.pending = queue.Queue(maxsize=num_buffers)
+        # A resumed run continues the numbering of the frames already on disk
+        self.frame = first_frame
+        self.dropped_frames = 0
+        self.error = None
+        self.chunk_file = None
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def _ensure_capacity(self, n):
+        # Buffers grow geometrically with the particle count. Only buffers currently owned by the simulation
+        # are touched here; the others are resized once they come back from the writer.
+        if n > self.capacity:
+            self.capacity = max(n, 2 * self.capacity, 1024)
+
+    def _fill(self, buffer, fields):
+        for name in fields:
+            field = getattr(self.ps, EXPORT_FIELDS[name])
+            arr = buffer.get(name)
+            if arr is None or arr.shape[0] < self.capacity:
+                shape = (self.capacity, self.ps.dim) if name in ('position', 'velocity') else (self.capacity,)
+                arr = np.empty(shape, dtype=_numpy_dtype(field))
+                buffer[name] = arr
+            if arr.ndim == 2:
+                self.ps.copy_to_numpy_nd(arr, field)
+            else:
+                self.ps.copy_to_numpy(arr, field)
+
+    def submit(self, time=0.0, fields=None):
+        # Queue the current particle state; fields selects a subset of the exporter's fields for this frame
+        if self.error is not None:
+            raise self.error
+        fields = self.fields if fields is None else tuple(fields)
+        for name in fields:
+            assert name in self.fields, name
+        try:
+            buffer = self.free_buffers.get(block=self.block)
+        except queue.Empty:
+            self.dropped_frames += 1
+            return False
+        n = self.ps.particle_num[None]
+        self._ensure_capacity(n)
+        self._fill(buffer, fields)
+        self.pending.put((self.frame, time, n, fields, buffer))
+        self.frame += 1
+        return True
+
+    def _writer_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            frame, time, n, fields, buffer = item
+            try:
+                if self.error is None:
+                    if self.format == 'npz':
+                        self._write_npz(frame, time, n, fields, buffer)
+                    else:
+                        self._write_raw(frame, time, n, fields, buffer)
+            except Exception as e:
+                self.error = e
+            self.free_buffers.put(buffer)
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+
+    def _write_npz(self, frame, time, n, fields, buffer):
+        # Renamed into place once complete, so readers polling the directory never see a partial frame
+        path = os.path.join(self.output_dir, 'frame_%05d.npz' % frame)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, frame=frame, time=time, **{name: buffer[name][:n] for name in fields})
+        os.replace(tmp_path, path)
+
+    def _write_raw(self, frame, time, n, fields, buffer):
+        if self.chunk_file is None or frame % self.frames_per_chunk == 0:
+            if self.chunk_file is not None:
+                self.chunk_file.close()
+            self.chunk_file = self._open_chunk(frame)
+        header = {
+            'frame': frame,
+            'time': time,
+            'n': n,
+            'fields': [[name, buffer[name].dtype.str, list(buffer[name].shape[1:])] for name in fields],
+        }
+        header = json.dumps(header).encode()
+        self.chunk_file.write(RAW_MAGIC + struct.pack('<I', len(header)) + header)
+        for name in fields:
+            self.chunk_file.write(memoryview(buffer[name][:n]))
+
+    def _open_chunk(self, frame):
+        path = os.path.join(self.output_dir, 'chunk_%04d.bin' % (frame // self.frames_per_chunk))
+        if frame % self.frames_per_chunk == 0 or not os.path.exists(path):
+            return open(path, 'wb')
+        # Resuming in the middle of a chunk: keep its frames before this one, drop any written after them
+        f = open(path, 'r+b')
+        end = _raw_frames_end(f, frame)
+        f.truncate(end)
+        f.seek(end)
+        return f
+
+    def close(self):
+        # Wait for the queued frames to be written
+        self.pending.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _raw_frames_end(f, frame):
+    # Offset just past the last complete frame numbered below frame
+    size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + 8 <= size:
+        f.seek(offset)
+        if f.read(4) != RAW_MAGIC:
+            break
+        header_size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_size))
+        end = f.tell() + sum(header['n'] * int(np.prod(shape)) * np.dtype(dtype).itemsize
+                             for _, dtype, shape in header['fields'])
+        if header['frame'] >= frame or end > size:
+            break
+        offset = end
+    return offset
+
+
+def _numpy_dtype(field):
+    return {ti.f32: np.float32, ti.f64: np.float64, ti.i32: np.int32, ti.i64: np.int64}[field.dtype]
+
+
+def read_raw_chunk(path):
+    # Yield (header, {name: array}) for every frame in a chunk written with format='raw'
+    with open(path, 'rb') as f:
+        while True:
+            magic = f.read(4)
+            if not magic:
+                break
+            assert magic == RAW_MAGIC
+            size, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(size))
+            arrays = {}
+            for name, dtype, shape in header['fields']:
+                dtype = np.dtype(dtype)
+                count = header['n'] * int(np.prod(shape))
+                arrays[name] = np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype).reshape(header['n'], *shape)
+            yield header, arrays
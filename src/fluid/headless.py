@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import time
+
+import taichi as ti
+
+from checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint
+from exporter import FrameExporter
+from profiler import StepProfiler
+
+# Same scene as demo.py: one tall column of water dropped into an 8 x 18 x 8 box
+DEFAULT_SCENE = {
+    'domain': [8, 18, 8],
+    'particle_system': {'skin': 0.1, 'single_precision': True},
+    'solver': {'adaptive_dt': True, 'fused': True},
+    'frame_dt': 5e-3,
+    'cubes': [{'lower_corner': [2, 2, 2],
+               'cube_size': [4, 12, 4],
+               'velocity': [0.0, 0.0, 0.0],
+               'density': 1000.0,
+               'color': 0x956333,
+               'material': 1}],
+    'spheres': [],
+    'boundary_boxes': [],
+}
+
+
+def load_scene(path):
+    scene = dict(DEFAULT_SCENE)
+    if path is not None:
+        with open(path) as f:
+            scene.update(json.load(f))
+    return scene
+
+
+def build_scene(scene):
+    # Imported here so that ti.init has already run
+    from particle_system import ParticleSystem
+    from wcsph import WCSPHSolver
+
+    ps = ParticleSystem(tuple(scene['domain']), **scene['particle_system'])
+    for cube in scene['cubes']:
+        ps.add_cube(**cube)
+    for sphere in scene['spheres']:
+        ps.add_sphere(**sphere)
+    for box in scene['boundary_boxes']:
+        ps.add_boundary_box(**box)
+    solver = WCSPHSolver(ps, **scene['solver'])
+    return ps, solver
+
+
+def run(scene, total_time, output_dir=None, frame_dt=None, verbose=True, export_format='npz',
+        export_fields=('position', 'velocity', 'material', 'color', 'id'), checkpoint_dir=None, checkpoint_interval=None,
+        restart=False, profile=False):
+    # Advance the scene to t = total_time without a window, optionally streaming every frame to output_dir
+    ps, solver = build_scene(scene)
+    frame_dt = frame_dt or scene['frame_dt']
+    # Resume from the newest checkpoint, if any, instead of the initial scene
+    if restart and checkpoint_dir is not None:
+        path = latest_checkpoint(checkpoint_dir)
+        if path is not None:
+            load_checkpoint(ps, solver, path)
+            if verbose:
+                print('restarted from %s at t %.4f' % (path, solver.time))
+    checkpoints = None
+    if checkpoint_dir is not None and checkpoint_interval is not None:
+        checkpoints = CheckpointWriter(ps, solver, checkpoint_dir, checkpoint_interval)
+    # Frames end at multiples of frame_dt, so a restarted run picks up the numbering where it stopped
+    first_frame = int(round(solver.time / frame_dt))
+    exporter = None
+    if output_dir is not None:
+        exporter = FrameExporter(ps, output_dir, fields=export_fields, format=export_format, first_frame=first_frame)
+    profiler = None
+    if profile:
+        profiler = StepProfiler(keep_trace=output_dir is not None).attach(solver)
+
+    start_time = solver.time
+    steps = 0
+    particle_updates = 0
+    frame = first_frame
+    start = time.perf_counter()
+    while solver.time < total_time - 1e-9:
+        frame_start_steps = steps
+        t_end = min((frame + 1) * frame_dt, total_time)
+        while solver.time < t_end - 1e-9:
+            solver.step(max_dt=t_end - solver.time)
+            steps += 1
+            particle_updates += ps.particle_num[None]
+        if exporter is not None:
+            exporter.submit(solver.time)
+        if checkpoints is not None:
+            checkpoints.maybe_save()
+        if verbose:
+            print('frame %d t %.4f steps %d particles %d' % (frame, solver.time, steps - frame_start_steps,
+                                                             ps.particle_num[None]))
+        if profiler is not None and verbose:
+            profiler.print_summary()
+        frame += 1
+    ti.sync()
+    wall = time.perf_counter() - start
+    if exporter is not None:
+        exporter.close()
+    if checkpoints is not None:
+        checkpoints.close()
+
+    stats = {
+        'simulated_time': solver.time - start_time,
+        'frames': frame - first_frame,
+        'steps': steps,
+        'particles': int(ps.particle_num[None]),
+        'wall_time': wall,
+        'steps_per_second': steps / wall,
+        'particle_updates_per_second': particle_updates / wall,
+    }
+    if output_dir is not None:
+        with open(os.path.join(output_dir, 'stats.json'), 'w') as f:
+            json.dump(stats, f, indent=2)
+        if profiler is not None:
+            profiler.export(os.path.join(output_dir, 'profile.json'))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the WCSPH solver without GGUI')
+    parser.add_argument('--scene', help='JSON scene config, keys as in DEFAULT_SCENE (default: the demo scene)')
+    parser.add_argument('--arch', default='cpu', choices=['cpu', 'gpu', 'cuda', 'vulkan', 'metal', 'opengl'])
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads (default: all cores)')
+    parser.add_argument('--time', type=float, default=1.0, help='simulated end time in seconds')
+    parser.add_argument('--frame-dt', type=float, default=None, help='simulated time between dumps')
+    parser.add_argument('--output', default=None, help='directory for frame dumps and stats.json')
+    parser.add_argument('--format', default='npz', choices=['npz', 'raw'], help='frame file format')
+    parser.add_argument('--fields', default='position,velocity,material,color,id', help='exported fields')
+    parser.add_argument('--checkpoint-dir', default=None, help='directory for periodic checkpoints')
+    parser.add_argument('--checkpoint-every', type=float, default=None, help='simulated seconds between checkpoints')
+    parser.add_argument('--restart', action='store_true', help='resume from the newest checkpoint in --checkpoint-dir')
+    parser.add_argument('--profile', action='store_true', help='time every phase of the step, trace in profile.json')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
+    init_kwargs = {}
+    if args.threads is not None:
+        init_kwargs['cpu_max_num_threads'] = args.threads
+    ti.init(arch=getattr(ti, args.arch), **init_kwargs)
+
+    stats = run(load_scene(args.scene), args.time, args.output, args.frame_dt, verbose=not args.quiet,
+                export_format=args.format, export_fields=args.fields.split(','), checkpoint_dir=args.checkpoint_dir,
+                checkpoint_interval=args.checkpoint_every, restart=args.restart,
+                profile=args.profile)
+    print('%d steps in %.2f s: %.1f steps/s, %.3e particle-updates/s' % (
+        stats['steps'], stats['wall_time'], stats['steps_per_second'], stats['particle_updates_per_second']))
+
+
+if __name__ == '__main__':
+    main()
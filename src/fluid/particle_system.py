@@ -1,11 +1,42 @@
+import warnings
+
 import taichi as ti
 import numpy as np
-from functools import reduce
+
+from prefix_sum import PrefixSumExecutor
+
+
+def morton_ranks(grid_num):
+    # Position of every cell, in row-major order, along the Z-order curve through the grid
+    cells = np.stack(np.meshgrid(*[np.arange(n) for n in grid_num], indexing='ij'), axis=-1).reshape(-1, len(grid_num))
+    codes = np.zeros(len(cells), dtype=np.int64)
+    bits = int(np.ceil(np.log2(max(int(np.max(grid_num)), 2))))
+    for b in range(bits):
+        for d in range(len(grid_num)):
+            codes |= ((cells[:, d] >> b) & 1).astype(np.int64) << (b * len(grid_num) + len(grid_num) - 1 - d)
+    ranks = np.empty(len(cells), dtype=np.int32)
+    ranks[np.argsort(codes, kind='stable')] = np.arange(len(cells), dtype=np.int32)
+    return ranks
+
+
+def cube_positions(lower_corner, cube_size, spacing):
+    num_dim = [np.arange(lower_corner[i], lower_corner[i] + cube_size[i], spacing) for i in range(len(lower_corner))]
+    return np.stack(np.meshgrid(*num_dim, indexing='ij'), axis=-1).reshape(-1, len(lower_corner))
+
+
+def sphere_positions(center, radius, spacing):
+    center = np.asarray(center, dtype=np.float32)
+    num_dim = [np.arange(c - radius, c + radius, spacing) for c in center]
+    positions = np.stack(np.meshgrid(*num_dim, indexing='ij'), axis=-1).reshape(-1, len(center))
+    return positions[np.linalg.norm(positions - center, axis=1) <= radius]
 
 
 @ti.data_oriented
 class ParticleSystem:
-    def __init__(self, res):
+    def __init__(self, res, store_neighbors=True, skin=0.0, single_precision=False,
+                 particle_max_num=None, growable=False, boundary_max_num=0, grid_backend='dense',
+                 hash_table_size=None, scene_num=1, morton_order=True, particle_max_num_neighbor=100,
+                 overflow_policy='warn', cell_histogram_size=64):
         self.res = res
         self.dim = len(res)
         assert self.dim > 1
@@ -18,60 +49,178 @@ class ParticleSystem:
         self.particle_radius = 0.1  # particle radius
         self.particle_diameter = 2 * self.particle_radius
         self.support_radius = self.particle_radius * 4.5  # support radius
+        # Verlet skin: neighbors are searched within support_radius + skin and the grid and neighbor lists
+        # are only rebuilt once some particle has moved more than skin / 2 since the last build
+        self.skin = skin
+        self.search_radius = self.support_radius + self.skin
         self.m_V = 0.8 * self.particle_diameter ** self.dim
-        self.particle_max_num = 2 ** 16
-        self.particle_max_num_per_cell = 100
-        self.particle_max_num_neighbor = 100
+        # With growable=True the particle fields live in pointer blocks that are only allocated once
+        # particles reach them, so particle_max_num is a cheap upper bound instead of a preallocation
+        self.growable = growable
+        self.particle_block_size = 1024
+        if particle_max_num is None:
+            particle_max_num = 2 ** 24 if growable else 2 ** 16
+        if growable:
+            particle_max_num = -(-particle_max_num // self.particle_block_size) * self.particle_block_size
+        self.particle_max_num = particle_max_num
+        self.particle_block_nodes = []
+        # (axis, lo, hi): particles added outside [lo, hi) along axis are skipped but still numbered, so one
+        # rank of a decomposed run holds its slab with the ids the full scene gives them
+        self.spawn_region = None
+        self.compaction_num = ti.field(int, shape=2)
+        self.particle_max_num_neighbor = particle_max_num_neighbor
+        # Keep a per-particle neighbor list, or walk the neighboring cells on the fly in for_all_neighbors
+        self.store_neighbors = store_neighbors
         self.particle_num = ti.field(int, shape=())
+        # Density and pressure are stored in f64 unless everything is kept in f32
+        self.single_precision = single_precision
+        self.density_dtype = ti.float32 if single_precision else ti.float64
+
+        # Independent scenes sharing the fields, told apart by scene_id. Every scene has its own grid buckets,
+        # so particles of different scenes never see each other and one kernel launch advances all of them.
+        self.scene_num = scene_num
 
         # Grid related properties
-        self.grid_size = self.support_radius
+        self.grid_size = self.search_radius
         self.grid_num = np.ceil(np.array(res) / self.grid_size).astype(int)
-        self.grid_particles_num = ti.field(int)
-        self.grid_particles = ti.field(int)
+        # 'dense' stores one bucket per cell of the domain. 'hash' maps the unbounded lattice of cells onto a
+        # table sized by the particle count, so mostly empty domains cost no memory and particles may leave res.
+        assert grid_backend in ('dense', 'hash')
+        self.grid_backend = grid_backend
+        if grid_backend == 'dense':
+            self.grid_num_per_scene = int(np.prod(self.grid_num))
+            self.grid_num_total = self.grid_num_per_scene * scene_num
+        else:
+            if hash_table_size is None:
+                hash_table_size = min(2 * self.particle_max_num, 2 ** 22)
+            self.grid_num_per_scene = hash_table_size
+            self.grid_num_total = hash_table_size
+        # Per-cell particle counts; after the prefix sum grid_particles_num[c] is the end offset of cell c
+        # in the cell-sorted particle arrays, so cell c owns [grid_particles_num[c - 1], grid_particles_num[c])
+        self.grid_particles_num = ti.field(int, shape=self.grid_num_total)
+        self.grid_particles_num_temp = ti.field(int, shape=self.grid_num_total)
+        # The dense grid numbers its buckets in Z-order (Morton order) of the cells rather than row-major, so
+        # the counting sort lays the particles out along a space-filling curve and particles that are close in
+        # space are also close in memory. Hashed buckets have no spatial order.
+        self.morton_order = morton_order and grid_backend == 'dense'
+        if self.morton_order:
+            self.cell_order = ti.field(int, shape=self.grid_num_per_scene)
+            self.cell_order.from_numpy(morton_ranks(self.grid_num))
+        self.prefix_sum_executor = PrefixSumExecutor(self.grid_num_total)
         self.padding = self.particle_radius*4.5
+        self.max_displacement = ti.field(float, shape=())
+        self.built_particle_num = -1
+        # Extra per-particle fields (and their sort buffers) reordered together with the particles
+        self.sorted_fields = []
+
+        # Diagnostics. The counters are updated by every grid build; the histograms only by diagnostics().
+        # overflow_policy decides what a rebuild that dropped neighbors does: 'ignore', 'warn' or 'raise'.
+        assert overflow_policy in ('ignore', 'warn', 'raise')
+        self.overflow_policy = overflow_policy
+        self.neighbor_overflow_num = ti.field(int, shape=())  # particles that lost neighbors to the cap
+        self.out_of_grid_num = ti.field(int, shape=())  # particles outside the grid, binned into an edge cell
+        self.neighbor_overflow_total = 0
+        self.max_neighbor_num = ti.field(int, shape=())
+        self.max_cell_occupancy = ti.field(int, shape=())
+        self.neighbor_histogram = ti.field(int, shape=self.particle_max_num_neighbor + 1)
+        # Cells holding cell_histogram_size - 1 or more particles share the last bin
+        self.cell_histogram = ti.field(int, shape=cell_histogram_size)
 
         # Particle related properties
         self.x = ti.Vector.field(self.dim, dtype=ti.float32)
         self.v = ti.Vector.field(self.dim, dtype=ti.float32)
-        self.density = ti.field(dtype=ti.float64)
-        self.pressure = ti.field(dtype=ti.float64)
+        self.density = ti.field(dtype=self.density_dtype)
+        self.pressure = ti.field(dtype=self.density_dtype)
         self.material = ti.field(dtype=int)
         self.color = ti.field(dtype=int)
-        self.particle_neighbors = ti.field(int)
+        self.scene_id = ti.field(dtype=int)
+        # Stable id given to every particle when it is added, it follows the particle through every reordering
+        self.particle_id = ti.field(dtype=int)
+        self.next_particle_id = 0
+        self.x_last_build = ti.Vector.field(self.dim, dtype=ti.float32)
         self.particle_neighbors_num = ti.field(int)
+        self.grid_ids = ti.field(int)
+
+        # Buffers for the counting sort
+        self.x_buffer = ti.Vector.field(self.dim, dtype=ti.float32)
+        self.v_buffer = ti.Vector.field(self.dim, dtype=ti.float32)
+        self.density_buffer = ti.field(dtype=self.density_dtype)
+        self.pressure_buffer = ti.field(dtype=self.density_dtype)
+        self.material_buffer = ti.field(dtype=int)
+        self.color_buffer = ti.field(dtype=int)
+        self.scene_id_buffer = ti.field(dtype=int)
+        self.particle_id_buffer = ti.field(dtype=int)
+        self.grid_ids_buffer = ti.field(int)
+        self.grid_ids_new = ti.field(int)
 
-        self.particles_node = ti.root.dense(ti.i, self.particle_max_num)
-        self.particles_node.place(self.x, self.v, self.density, self.pressure, self.material, self.color)
-        self.particles_node.place(self.particle_neighbors_num)
-        self.particle_node = self.particles_node.dense(ti.j, self.particle_max_num_neighbor)
-        self.particle_node.place(self.particle_neighbors)
+        self.particles_node = self.place_particle_fields(self.x, self.v, self.density, self.pressure,
+                                                         self.material, self.color, self.scene_id,
+                                                         self.particle_id)
+        self.particles_node.place(self.x_last_build)
+        self.particles_node.place(self.particle_neighbors_num, self.grid_ids)
+        self.particles_node.place(self.x_buffer, self.v_buffer, self.density_buffer, self.pressure_buffer,
+                                  self.material_buffer, self.color_buffer, self.scene_id_buffer,
+                                  self.particle_id_buffer)
+        self.particles_node.place(self.grid_ids_buffer, self.grid_ids_new)
+        if self.store_neighbors:
+            self.particle_neighbors = ti.field(int)
+            self.particle_node = self.particles_node.dense(ti.j, self.particle_max_num_neighbor)
+            self.particle_node.place(self.particle_neighbors)
 
-        index = ti.ij if self.dim == 2 else ti.ijk
-        grid_node = ti.root.dense(index, self.grid_num)
-        grid_node.place(self.grid_particles_num)
+        # Static boundary samples, binned once into their own cell-sorted grid. Their Akinci volumes
+        # are computed by the solver after every change and cached in boundary_volume. With several
+        # scenes the boundary is shared by all of them.
+        self.boundary_max_num = boundary_max_num
+        self.boundary_num = ti.field(int, shape=())
+        self.boundary_dirty = False
+        if self.boundary_max_num > 0:
+            self.boundary_x = ti.Vector.field(self.dim, dtype=ti.float32)
+            self.boundary_volume = ti.field(dtype=float)
+            self.boundary_grid_ids = ti.field(int)
+            self.boundary_x_buffer = ti.Vector.field(self.dim, dtype=ti.float32)
+            self.boundary_grid_ids_buffer = ti.field(int)
+            ti.root.dense(ti.i, self.boundary_max_num).place(self.boundary_x, self.boundary_volume,
+                                                             self.boundary_grid_ids, self.boundary_x_buffer,
+                                                             self.boundary_grid_ids_buffer)
+            self.boundary_grid_num = ti.field(int, shape=self.grid_num_total)
+            self.boundary_grid_num_temp = ti.field(int, shape=self.grid_num_total)
 
-        cell_index = ti.k if self.dim == 2 else ti.l
-        cell_node = grid_node.dense(cell_index, self.particle_max_num_per_cell)
-        cell_node.place(self.grid_particles)
+    def place_particle_fields(self, *fields):
+        # Every per-particle field, including the solvers', shares the particle layout
+        if self.growable:
+            block_node = ti.root.pointer(ti.i, self.particle_max_num // self.particle_block_size)
+            self.particle_block_nodes.append(block_node)
+            node = block_node.dense(ti.i, self.particle_block_size)
+        else:
+            node = ti.root.dense(ti.i, self.particle_max_num)
+        node.place(*fields)
+        return node
+
+    @ti.kernel
+    def deactivate_blocks(self, block_node: ti.template(), first_block: int):
+        for b in range(first_block, self.particle_max_num // self.particle_block_size):
+            ti.deactivate(block_node, ti.cast(b, ti.i32))
 
     @ti.func
-    def add_particle(self, p, x, v, density, pressure, material, color):
+    def add_particle(self, p, x, v, density, pressure, material, color, scene):
         self.x[p] = x
         self.v[p] = v
         self.density[p] = density
         self.pressure[p] = pressure
         self.material[p] = material
         self.color[p] = color
+        self.scene_id[p] = scene
 
     @ti.kernel
     def add_particles(self, new_particles_num: int,
+                      new_particles_id: ti.types.ndarray(),
                       new_particles_positions: ti.types.ndarray(),
                       new_particles_velocity: ti.types.ndarray(),
                       new_particle_density: ti.types.ndarray(),
                       new_particle_pressure: ti.types.ndarray(),
                       new_particles_material: ti.types.ndarray(),
-                      new_particles_color: ti.types.ndarray()):
+                      new_particles_color: ti.types.ndarray(),
+                      new_particles_scene: ti.types.ndarray()):
         for p in range(self.particle_num[None], self.particle_num[None] + new_particles_num):
             v = ti.Vector.zero(float, self.dim)
             x = ti.Vector.zero(float, self.dim)
@@ -82,16 +231,92 @@ class ParticleSystem:
                               new_particle_density[p - self.particle_num[None]],
                               new_particle_pressure[p - self.particle_num[None]],
                               new_particles_material[p - self.particle_num[None]],
-                              new_particles_color[p - self.particle_num[None]])
+                              new_particles_color[p - self.particle_num[None]],
+                              new_particles_scene[p - self.particle_num[None]])
+            self.particle_id[p] = new_particles_id[p - self.particle_num[None]]
         self.particle_num[None] += new_particles_num
 
     @ti.func
     def pos_to_index(self, pos):
-        return (pos / self.grid_size).cast(int)
+        return ti.floor(pos / self.grid_size, int)
 
     @ti.func
     def is_valid_cell(self, cell):
-        # Check whether the cell is in the grid
+        # Check whether the cell is in the grid, the hashed grid has no bounds
+        flag = True
+        if ti.static(self.grid_backend == 'dense'):
+            for d in ti.static(range(self.dim)):
+                flag = flag and (0 <= cell[d] < self.grid_num[d])
+        return flag
+
+    @ti.func
+    def flatten_grid_index(self, cell, scene=0):
+        # Bucket of the cell: its row-major index, or its spatial hash (Teschner et al. 2003)
+        index = 0
+        if ti.static(self.grid_backend == 'dense'):
+            for d in ti.static(range(self.dim)):
+                index = index * self.grid_num[d] + cell[d]
+            if ti.static(self.morton_order):
+                index = self.cell_order[index]
+            if ti.static(self.scene_num > 1):
+                index += scene * self.grid_num_per_scene
+        else:
+            primes = ti.static([73856093, 19349663, 83492791])
+            h = ti.u32(0)
+            for d in ti.static(range(self.dim)):
+                h ^= ti.cast(cell[d], ti.u32) * ti.u32(primes[d])
+            if ti.static(self.scene_num > 1):
+                h ^= ti.cast(scene, ti.u32) * ti.u32(2654435761)
+            index = ti.cast(h % ti.u32(self.grid_num_total), int)
+        return index
+
+    @ti.func
+    def get_scene(self, p):
+        scene = 0
+        if ti.static(self.scene_num > 1):
+            scene = self.scene_id[p]
+        return scene
+
+    @ti.func
+    def same_scene(self, p_i, p_j):
+        # Buckets of different scenes only collide in the hashed grid
+        flag = True
+        if ti.static(self.scene_num > 1 and self.grid_backend == 'hash'):
+            flag = self.scene_id[p_i] == self.scene_id[p_j]
+        return flag
+
+    @ti.func
+    def clamp_cell(self, cell):
+        res = cell
+        if ti.static(self.grid_backend == 'dense'):
+            for d in ti.static(range(self.dim)):
+                res[d] = ti.min(ti.max(cell[d], 0), self.grid_num[d] - 1)
+        return res
+
+    @ti.func
+    def in_cell(self, pos, cell):
+        # Several cells may share a hash bucket, so bucket entries are checked against the cell actually visited
+        flag = True
+        if ti.static(self.grid_backend == 'hash'):
+            flag = (self.pos_to_index(pos) == cell).all()
+        return flag
+
+    @ti.func
+    def get_flatten_grid_index(self, pos, scene=0):
+        # Particles that left the domain are binned into the nearest boundary cell
+        return self.flatten_grid_index(self.clamp_cell(self.pos_to_index(pos)), scene)
+
+    @ti.func
+    def grid_start(self, grid_index):
+        start = 0
+        if grid_index > 0:
+            start = self.grid_particles_num[grid_index - 1]
+        return start
+
+    @ti.func
+    def in_grid(self, pos):
+        # Inside the cells of the dense grid, whatever the backend
+        cell = self.pos_to_index(pos)
         flag = True
         for d in ti.static(range(self.dim)):
             flag = flag and (0 <= cell[d] < self.grid_num[d])
@@ -99,38 +324,309 @@ class ParticleSystem:
 
     @ti.kernel
     def allocate_particles_to_grid(self):
+        for c in range(self.grid_num_total):
+            self.grid_particles_num[c] = 0
+        self.out_of_grid_num[None] = 0
         for p in range(self.particle_num[None]):
-            cell = self.pos_to_index(self.x[p])
-            offset = ti.atomic_add(self.grid_particles_num[cell], 1)
-            self.grid_particles[cell, offset] = p
+            if not self.in_grid(self.x[p]):
+                self.out_of_grid_num[None] += 1
+            grid_index = self.get_flatten_grid_index(self.x[p], self.get_scene(p))
+            self.grid_ids[p] = grid_index
+            ti.atomic_add(self.grid_particles_num[grid_index], 1)
+        for c in range(self.grid_num_total):
+            self.grid_particles_num_temp[c] = self.grid_particles_num[c]
+
+    @ti.kernel
+    def counting_sort(self):
+        # Reorder the particle data into cell order, so every cell is a contiguous range
+        for i in range(self.particle_num[None]):
+            p = self.particle_num[None] - 1 - i
+            offset = ti.atomic_sub(self.grid_particles_num_temp[self.grid_ids[p]], 1) - 1
+            self.grid_ids_new[p] = self.grid_start(self.grid_ids[p]) + offset
+
+    @ti.kernel
+    def apply_permutation(self):
+        # Move particle p to grid_ids_new[p]
+        for p in range(self.particle_num[None]):
+            new_index = self.grid_ids_new[p]
+            self.grid_ids_buffer[new_index] = self.grid_ids[p]
+            self.x_buffer[new_index] = self.x[p]
+            self.v_buffer[new_index] = self.v[p]
+            self.density_buffer[new_index] = self.density[p]
+            self.pressure_buffer[new_index] = self.pressure[p]
+            self.material_buffer[new_index] = self.material[p]
+            self.color_buffer[new_index] = self.color[p]
+            self.scene_id_buffer[new_index] = self.scene_id[p]
+            self.particle_id_buffer[new_index] = self.particle_id[p]
+        for p in range(self.particle_num[None]):
+            self.grid_ids[p] = self.grid_ids_buffer[p]
+            self.x[p] = self.x_buffer[p]
+            self.x_last_build[p] = self.x_buffer[p]
+            self.v[p] = self.v_buffer[p]
+            self.density[p] = self.density_buffer[p]
+            self.pressure[p] = self.pressure_buffer[p]
+            self.material[p] = self.material_buffer[p]
+            self.color[p] = self.color_buffer[p]
+            self.scene_id[p] = self.scene_id_buffer[p]
+            self.particle_id[p] = self.particle_id_buffer[p]
+
+    def permute_particles(self):
+        self.apply_permutation()
+        for field, buffer in self.sorted_fields:
+            self.reorder_field(field, buffer)
+
+    def register_sorted_field(self, field):
+        # Solver state kept across steps has to follow its particle through the counting sort
+        if isinstance(field, ti.MatrixField):
+            buffer = ti.Vector.field(field.n, dtype=field.dtype)
+        else:
+            buffer = ti.field(dtype=field.dtype)
+        self.place_particle_fields(buffer)
+        self.sorted_fields.append((field, buffer))
+
+    @ti.kernel
+    def reorder_field(self, field: ti.template(), buffer: ti.template()):
+        for p in range(self.particle_num[None]):
+            buffer[self.grid_ids_new[p]] = field[p]
+        for p in range(self.particle_num[None]):
+            field[p] = buffer[p]
 
     @ti.kernel
     def search_neighbors(self):
+        self.neighbor_overflow_num[None] = 0
         for p_i in range(self.particle_num[None]):
             # Skip boundary particles
             if self.material[p_i] == self.material_boundary:
                 continue
-            center_cell = self.pos_to_index(self.x[p_i])
+            # Particles outside the grid were binned into the edge cells, so the search starts from a clamped cell too
+            center_cell = self.clamp_cell(self.pos_to_index(self.x[p_i]))
+            scene = self.get_scene(p_i)
             cnt = 0
+            overflow = False
             for offset in ti.grouped(ti.ndrange(*((-1, 2),) * self.dim)):
-                if cnt >= self.particle_max_num_neighbor:
+                if overflow:
                     break
                 cell = center_cell + offset
                 if not self.is_valid_cell(cell):
-                    break
-                for j in range(self.grid_particles_num[cell]):
-                    p_j = self.grid_particles[cell, j]
+                    continue
+                grid_index = self.flatten_grid_index(cell, scene)
+                for p_j in range(self.grid_start(grid_index), self.grid_particles_num[grid_index]):
                     distance = (self.x[p_i] - self.x[p_j]).norm()
-                    if p_i != p_j and distance < self.support_radius:
-                        self.particle_neighbors[p_i, cnt] = p_j
-                        cnt += 1
+                    if p_i != p_j and distance < self.search_radius and self.in_cell(self.x[p_j], cell) \
+                            and self.same_scene(p_i, p_j):
+                        if cnt < self.particle_max_num_neighbor:
+                            self.particle_neighbors[p_i, cnt] = p_j
+                            cnt += 1
+                        else:
+                            overflow = True
+            if overflow:
+                self.neighbor_overflow_num[None] += 1
             self.particle_neighbors_num[p_i] = cnt
 
-    def initialize_particle_system(self):
-        self.grid_particles_num.fill(0)
-        self.particle_neighbors.fill(-1)
+    @ti.func
+    def for_all_neighbors(self, p_i, task: ti.template(), ret: ti.template()):
+        # Call task(p_i, p_j, ret) for every neighbor p_j of p_i
+        if ti.static(self.store_neighbors):
+            for j in range(self.particle_neighbors_num[p_i]):
+                p_j = self.particle_neighbors[p_i, j]
+                if ti.static(self.skin == 0.0):
+                    task(p_i, p_j, ret)
+                elif (self.x[p_i] - self.x[p_j]).norm() < self.support_radius:
+                    task(p_i, p_j, ret)
+        else:
+            # The grid was built from the positions at the last rebuild, out-of-grid particles in the edge cells
+            center_cell = self.clamp_cell(self.pos_to_index(self.x_last_build[p_i]))
+            scene = self.get_scene(p_i)
+            for offset in ti.grouped(ti.ndrange(*((-1, 2),) * self.dim)):
+                cell = center_cell + offset
+                if self.is_valid_cell(cell):
+                    grid_index = self.flatten_grid_index(cell, scene)
+                    for p_j in range(self.grid_start(grid_index), self.grid_particles_num[grid_index]):
+                        if p_i != p_j and (self.x[p_i] - self.x[p_j]).norm() < self.support_radius \
+                                and self.in_cell(self.x_last_build[p_j], cell) and self.same_scene(p_i, p_j):
+                            task(p_i, p_j, ret)
+
+    @ti.kernel
+    def add_boundary_particles(self, new_boundary_num: int, new_positions: ti.types.ndarray()):
+        for p in range(self.boundary_num[None], self.boundary_num[None] + new_boundary_num):
+            for d in ti.static(range(self.dim)):
+                self.boundary_x[p][d] = new_positions[p - self.boundary_num[None], d]
+        self.boundary_num[None] += new_boundary_num
+
+    @ti.kernel
+    def build_boundary_grid(self):
+        for c in range(self.grid_num_total):
+            self.boundary_grid_num[c] = 0
+        for b in range(self.boundary_num[None]):
+            grid_index = self.get_flatten_grid_index(self.boundary_x[b])
+            self.boundary_grid_ids[b] = grid_index
+            ti.atomic_add(self.boundary_grid_num[grid_index], 1)
+        for c in range(self.grid_num_total):
+            self.boundary_grid_num_temp[c] = self.boundary_grid_num[c]
+
+    @ti.kernel
+    def boundary_counting_sort(self):
+        for b in range(self.boundary_num[None]):
+            grid_index = self.boundary_grid_ids[b]
+            start = 0
+            if grid_index > 0:
+                start = self.boundary_grid_num[grid_index - 1]
+            new_index = start + ti.atomic_sub(self.boundary_grid_num_temp[grid_index], 1) - 1
+            self.boundary_grid_ids_buffer[new_index] = grid_index
+            self.boundary_x_buffer[new_index] = self.boundary_x[b]
+        for b in range(self.boundary_num[None]):
+            self.boundary_grid_ids[b] = self.boundary_grid_ids_buffer[b]
+            self.boundary_x[b] = self.boundary_x_buffer[b]
+
+    def build_boundary(self):
+        self.build_boundary_grid()
+        self.prefix_sum_executor.run(self.boundary_grid_num)
+        self.boundary_counting_sort()
+
+    @ti.func
+    def for_all_boundary_neighbors(self, p_i, task: ti.template(), ret: ti.template()):
+        # Call task(p_i, b, ret) for every boundary sample b within the support radius of particle p_i
+        if ti.static(self.boundary_max_num > 0):
+            self.for_boundary_samples_near(self.x[p_i], p_i, task, ret)
+
+    @ti.func
+    def for_boundary_samples_near(self, pos, i, task: ti.template(), ret: ti.template()):
+        # Samples outside the grid were clamped into the edge cells, so the search starts from a clamped cell too
+        if ti.static(self.boundary_max_num > 0):
+            center_cell = self.clamp_cell(self.pos_to_index(pos))
+            for offset in ti.grouped(ti.ndrange(*((-1, 2),) * self.dim)):
+                cell = center_cell + offset
+                if self.is_valid_cell(cell):
+                    grid_index = self.flatten_grid_index(cell)
+                    start = 0
+                    if grid_index > 0:
+                        start = self.boundary_grid_num[grid_index - 1]
+                    for b in range(start, self.boundary_grid_num[grid_index]):
+                        if (pos - self.boundary_x[b]).norm() < self.support_radius \
+                                and self.in_cell(self.boundary_x[b], cell):
+                            task(i, b, ret)
+
+    @ti.kernel
+    def compute_max_displacement(self):
+        self.max_displacement[None] = 0.0
+        for p in range(self.particle_num[None]):
+            ti.atomic_max(self.max_displacement[None], (self.x[p] - self.x_last_build[p]).norm())
+
+    def need_rebuild(self):
+        if self.skin == 0.0 or self.built_particle_num != self.particle_num[None]:
+            return True
+        self.compute_max_displacement()
+        return self.max_displacement[None] > 0.5 * self.skin
+
+    def build_grid(self):
         self.allocate_particles_to_grid()
-        self.search_neighbors()
+        self.prefix_sum_executor.run(self.grid_particles_num)
+        self.counting_sort()
+        self.permute_particles()
+
+    def build_neighbor_lists(self):
+        if self.store_neighbors:
+            self.particle_neighbors.fill(-1)
+            self.search_neighbors()
+            if self.overflow_policy != 'ignore':
+                self.check_overflow()
+        self.built_particle_num = self.particle_num[None]
+
+    def check_overflow(self):
+        overflow = self.neighbor_overflow_num[None]
+        if overflow > 0:
+            self.neighbor_overflow_total += overflow
+            msg = '%d particles have more than particle_max_num_neighbor = %d neighbors, the rest were dropped' % (
+                overflow, self.particle_max_num_neighbor)
+            if self.overflow_policy == 'raise':
+                raise RuntimeError(msg)
+            warnings.warn(msg, RuntimeWarning)
+
+    @ti.kernel
+    def compute_histograms(self):
+        for b in range(self.particle_max_num_neighbor + 1):
+            self.neighbor_histogram[b] = 0
+        for b in range(self.cell_histogram.shape[0]):
+            self.cell_histogram[b] = 0
+        self.max_neighbor_num[None] = 0
+        self.max_cell_occupancy[None] = 0
+        if ti.static(self.store_neighbors):
+            for p in range(self.particle_num[None]):
+                if self.material[p] != self.material_boundary:
+                    num = self.particle_neighbors_num[p]
+                    self.neighbor_histogram[num] += 1
+                    ti.atomic_max(self.max_neighbor_num[None], num)
+        for c in range(self.grid_num_total):
+            num = self.grid_particles_num[c] - self.grid_start(c)
+            if num > 0:
+                self.cell_histogram[ti.min(num, self.cell_histogram.shape[0] - 1)] += 1
+                ti.atomic_max(self.max_cell_occupancy[None], num)
+
+    def diagnostics(self):
+        # Occupancy statistics of the last grid build; a few passes over the particles and cells
+        self.compute_histograms()
+        neighbor_histogram = self.neighbor_histogram.to_numpy()
+        cell_histogram = self.cell_histogram.to_numpy()
+        cell_histogram[0] = self.grid_num_total - cell_histogram[1:].sum()
+        listed = neighbor_histogram.sum()
+        return {
+            'particles': int(self.particle_num[None]),
+            'out_of_grid': int(self.out_of_grid_num[None]),
+            'neighbor_overflow': int(self.neighbor_overflow_num[None]) if self.store_neighbors else 0,
+            'neighbor_overflow_total': self.neighbor_overflow_total,
+            'max_neighbors': int(self.max_neighbor_num[None]),
+            'mean_neighbors': float(np.dot(neighbor_histogram, np.arange(len(neighbor_histogram))) / max(listed, 1)),
+            'neighbor_histogram': neighbor_histogram,
+            'max_cell_occupancy': int(self.max_cell_occupancy[None]),
+            'cell_histogram': cell_histogram,
+        }
+
+    def suggest_neighbor_capacity(self, margin=1.2):
+        # particle_max_num_neighbor that would have held the densest neighborhood of the last build
+        return int(np.ceil(self.diagnostics()['max_neighbors'] * margin))
+
+    def initialize_particle_system(self):
+        self.build_grid()
+        self.build_neighbor_lists()
+
+    def update_particle_system(self):
+        # Rebuild the grid and neighbor lists only when the Verlet skin has been used up
+        if self.need_rebuild():
+            self.initialize_particle_system()
+
+    @ti.kernel
+    def count_neighbors(self) -> int:
+        # Total number of stored neighbors over the fluid particles
+        total = 0
+        for p in range(self.particle_num[None]):
+            if self.material[p] != self.material_boundary:
+                total += self.particle_neighbors_num[p]
+        return total
+
+    @ti.kernel
+    def compute_compaction(self, removed: ti.types.ndarray(), kept_num: int):
+        # Kept particles move to the front, removed ones behind them
+        self.compaction_num[0] = 0
+        self.compaction_num[1] = 0
+        for p in range(self.particle_num[None]):
+            if removed[p] == 0:
+                self.grid_ids_new[p] = ti.atomic_add(self.compaction_num[0], 1)
+            else:
+                self.grid_ids_new[p] = kept_num + ti.atomic_add(self.compaction_num[1], 1)
+
+    def delete_particles(self, removed):
+        # removed: boolean mask or index array over the current particles
+        particle_num = self.particle_num[None]
+        mask = np.zeros(particle_num, dtype=np.int32)
+        mask[np.asarray(removed)] = 1
+        kept_num = particle_num - int(mask.sum())
+        self.compute_compaction(mask, kept_num)
+        self.permute_particles()
+        self.particle_num[None] = kept_num
+        if self.growable:
+            first_block = -(-kept_num // self.particle_block_size)
+            for block_node in self.particle_block_nodes:
+                self.deactivate_blocks(block_node, first_block)
 
     @ti.kernel
     def copy_to_numpy_nd(self, np_arr: ti.types.ndarray(), src_arr: ti.template()):
@@ -143,6 +639,17 @@ class ParticleSystem:
         for i in range(self.particle_num[None]):
             np_arr[i] = src_arr[i]
 
+    @ti.kernel
+    def copy_from_numpy_nd(self, dst_arr: ti.template(), np_arr: ti.types.ndarray()):
+        for i in range(self.particle_num[None]):
+            for j in ti.static(range(self.dim)):
+                dst_arr[i][j] = np_arr[i, j]
+
+    @ti.kernel
+    def copy_from_numpy(self, dst_arr: ti.template(), np_arr: ti.types.ndarray()):
+        for i in range(self.particle_num[None]):
+            dst_arr[i] = np_arr[i]
+
     def dump(self):
         np_x = np.ndarray((self.particle_num[None], self.dim), dtype=np.float32)
         self.copy_to_numpy_nd(np_x, self.x)
@@ -156,12 +663,50 @@ class ParticleSystem:
         np_color = np.ndarray((self.particle_num[None],), dtype=np.int32)
         self.copy_to_numpy(np_color, self.color)
 
-        return {
+        np_id = np.ndarray((self.particle_num[None],), dtype=np.int32)
+        self.copy_to_numpy(np_id, self.particle_id)
+
+        res = {
             'position': np_x,
             'velocity': np_v,
             'material': np_material,
-            'color': np_color
+            'color': np_color,
+            'id': np_id
         }
+        if self.scene_num > 1:
+            np_scene = np.ndarray((self.particle_num[None],), dtype=np.int32)
+            self.copy_to_numpy(np_scene, self.scene_id)
+            res['scene'] = np_scene
+        return res
+
+    def add_particles_from_numpy(self, positions, material, color=0xFFFFFF, density=None, pressure=None,
+                                 velocity=None, scene=0):
+        # Bulk-add particles; scalar and per-particle attribute values are both accepted
+        positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, self.dim)
+        num_new_particles = positions.shape[0]
+        assert np.all((0 <= np.asarray(scene)) & (np.asarray(scene) < self.scene_num))
+
+        def expand(value, shape, dtype):
+            return np.broadcast_to(np.asarray(value, dtype=dtype), shape)
+
+        ids = np.arange(self.next_particle_id, self.next_particle_id + num_new_particles, dtype=np.int32)
+        velocity = expand(0.0 if velocity is None else velocity, positions.shape, np.float32)
+        density = expand(1000. if density is None else density, num_new_particles, np.float32)
+        pressure = expand(0. if pressure is None else pressure, num_new_particles, np.float32)
+        material = expand(material, num_new_particles, np.int32)
+        color = expand(color, num_new_particles, np.int32)
+        scene = expand(scene, num_new_particles, np.int32)
+        self.next_particle_id += num_new_particles
+        keep = slice(None)
+        if self.spawn_region is not None:
+            axis, lo, hi = self.spawn_region
+            keep = (positions[:, axis] >= lo) & (positions[:, axis] < hi)
+        arrays = [np.ascontiguousarray(arr[keep]) for arr in (ids, positions, velocity, density, pressure, material,
+                                                               color, scene)]
+        num_kept = len(arrays[0])
+        assert self.particle_num[None] + num_kept <= self.particle_max_num
+        if num_kept > 0:
+            self.add_particles(num_kept, *arrays)
 
     def add_cube(self,
                  lower_corner,
@@ -170,31 +715,38 @@ class ParticleSystem:
                  color=0xFFFFFF,
                  density=None,
                  pressure=None,
-                 velocity=None):
-
-        num_dim = []
-        for i in range(self.dim):
-            num_dim.append(
-                np.arange(lower_corner[i], lower_corner[i] + cube_size[i],
-                          self.particle_radius*2.8))
-        num_new_particles = reduce(lambda x, y: x * y,
-                                   [len(n) for n in num_dim])
-        assert self.particle_num[None] + num_new_particles <= self.particle_max_num
-
-        new_positions = np.array(np.meshgrid(*num_dim,
-                                             sparse=False,
-                                             indexing='ij'),
-                                 dtype=np.float32)
-        new_positions = new_positions.reshape(-1,
-                                              reduce(lambda x, y: x * y, list(new_positions.shape[1:]))).transpose()
+                 velocity=None,
+                 scene=0):
+
+        new_positions = cube_positions(lower_corner, cube_size, self.particle_radius * 2.8)
         print("new position shape ", new_positions.shape)
-        if velocity is None:
-            velocity = np.full_like(new_positions, 0)
-        else:
-            velocity = np.array([velocity for _ in range(num_new_particles)], dtype=np.float32)
+        self.add_particles_from_numpy(new_positions, material, color, density, pressure, velocity, scene)
+
+    def add_boundary_from_numpy(self, positions):
+        positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, self.dim)
+        assert self.boundary_num[None] + positions.shape[0] <= self.boundary_max_num
+        self.add_boundary_particles(positions.shape[0], positions)
+        self.boundary_dirty = True
+
+    def add_boundary_box(self, lower_corner, cube_size, layers=2):
+        # Hollow container: layers of boundary samples wrapped around the box, spaced one particle diameter
+        lower = np.asarray(lower_corner, dtype=np.float32)
+        upper = lower + np.asarray(cube_size, dtype=np.float32)
+        thickness = layers * self.particle_diameter
+        num_dim = [np.arange(lower[i] - thickness + 0.5 * self.particle_diameter, upper[i] + thickness,
+                             self.particle_diameter) for i in range(self.dim)]
+        positions = np.stack(np.meshgrid(*num_dim, indexing='ij'), axis=-1).reshape(-1, self.dim)
+        outside = np.any((positions < lower) | (positions > upper), axis=1)
+        self.add_boundary_from_numpy(positions[outside])
 
-        material = np.full_like(np.zeros(num_new_particles), material)
-        color = np.full_like(np.zeros(num_new_particles), color)
-        density = np.full_like(np.zeros(num_new_particles), density if density is not None else 1000.)
-        pressure = np.full_like(np.zeros(num_new_particles), pressure if pressure is not None else 0.)
-        self.add_particles(num_new_particles, new_positions, velocity, density, pressure, material, color)
+    def add_sphere(self,
+                   center,
+                   radius,
+                   material,
+                   color=0xFFFFFF,
+                   density=None,
+                   pressure=None,
+                   velocity=None,
+                   scene=0):
+        new_positions = sphere_positions(center, radius, self.particle_radius * 2.8)
+        self.add_particles_from_numpy(new_positions, material, color, density, pressure, velocity, scene)
@@ -0,0 +1,33 @@
+import numpy as np
+import taichi as ti
+
+
+@ti.data_oriented
+class PrefixSumExecutor:
+    # Inclusive parallel prefix sum. ti.algorithms.PrefixSumExecutor only supports cuda/vulkan,
+    # this one scans sqrt(n)-sized blocks in parallel and runs on every backend.
+    def __init__(self, length):
+        self.length = length
+        self.block_size = max(int(np.ceil(np.sqrt(length))), 1)
+        self.block_num = (length + self.block_size - 1) // self.block_size
+        self.block_sum = ti.field(int, shape=self.block_num)
+
+    @ti.kernel
+    def scan(self, arr: ti.template(), length: int):
+        block_num = (length + self.block_size - 1) // self.block_size
+        for b in range(block_num):
+            acc = 0
+            for k in range(b * self.block_size, ti.min((b + 1) * self.block_size, length)):
+                acc += arr[k]
+                arr[k] = acc
+            self.block_sum[b] = acc
+        ti.loop_config(serialize=True)
+        for b in range(1, block_num):
+            self.block_sum[b] += self.block_sum[b - 1]
+        for k in range(self.block_size, length):
+            arr[k] += self.block_sum[k // self.block_size - 1]
+
+    def run(self, arr, length=None):
+        # Scans the first length entries, at most the length the executor was made for; all of them by default
+        assert length is None or length <= self.length
+        self.scan(arr, self.length if length is None else length)
@@ -0,0 +1,139 @@
+import collections
+import json
+import time
+
+import taichi as ti
+
+
+class StepHook:
+    # Interface of the hooks called by SPHBase.step; subclasses override what they need
+    def begin_step(self, solver):
+        pass
+
+    def begin_phase(self, solver, name):
+        pass
+
+    def end_phase(self, solver, name):
+        pass
+
+    def end_step(self, solver):
+        pass
+
+
+class StepProfiler(StepHook):
+    # Wall time of every phase of SPHBase.step, plus per-step counters. Keeps a rolling window of steps
+    # for summary() and, with keep_trace=True, the full per-step trace for export.
+    def __init__(self, window=100, keep_trace=True, sync=True, count_neighbors=True, kernel_profiler=False):
+        self.window = window
+        self.keep_trace = keep_trace
+        # Kernel launches are asynchronous on the GPU backends, so every phase boundary synchronises
+        self.sync = sync
+        self.count_neighbors = count_neighbors
+        # Needs ti.init(kernel_profiler=True)
+        self.kernel_profiler = kernel_profiler
+        self.recent = collections.deque(maxlen=window)
+        self.trace = []
+        self.step_num = 0
+        self.current = None
+        self.phase_starts = []  # stack, phases may nest
+        self.step_start = 0.0
+        self.avg_neighbors = None
+
+    def attach(self, solver):
+        solver.add_hook(self)
+        return self
+
+    def detach(self, solver):
+        solver.remove_hook(self)
+
+    def _now(self):
+        if self.sync:
+            ti.sync()
+        return time.perf_counter()
+
+    def begin_step(self, solver):
+        self.current = {'step': self.step_num, 'time': solver.time, 'phases': {}}
+        self.step_start = self._now()
+
+    def begin_phase(self, solver, name):
+        self.phase_starts.append(self._now())
+
+    def end_phase(self, solver, name):
+        elapsed = self._now() - self.phase_starts.pop()
+        if self.current is not None:
+            phases = self.current['phases']
+            phases[name] = phases.get(name, 0.0) + elapsed
+
+    def end_step(self, solver):
+        record = self.current
+        record['total'] = self._now() - self.step_start
+        record['dt'] = float(solver.dt[None])
+        record['particles'] = int(solver.ps.particle_num[None])
+        record['rebuilt'] = solver.rebuilt
+        if self.count_neighbors and solver.ps.store_neighbors and record['particles'] > 0:
+            # Neighbor lists only change when they are rebuilt
+            if solver.rebuilt or self.avg_neighbors is None:
+                self.avg_neighbors = solver.ps.count_neighbors() / record['particles']
+            record['avg_neighbors'] = self.avg_neighbors
+        if solver.rebuilt:
+            # Overflow counters of the grid build, see ParticleSystem.diagnostics
+            record['out_of_grid'] = int(solver.ps.out_of_grid_num[None])
+            if solver.ps.store_neighbors:
+                record['neighbor_overflow'] = int(solver.ps.neighbor_overflow_num[None])
+        for name in ('pressure_iterations', 'divergence_iterations'):
+            if hasattr(solver, name):
+                record[name] = getattr(solver, name)
+        self.recent.append(record)
+        if self.keep_trace:
+            self.trace.append(record)
+        self.current = None
+        self.step_num += 1
+
+    def summary(self):
+        # Mean and max of every phase and counter over the rolling window
+        phases = collections.defaultdict(list)
+        for record in self.recent:
+            for name, elapsed in record['phases'].items():
+                phases[name].append(elapsed)
+        totals = [record['total'] for record in self.recent]
+        res = {
+            'steps': len(self.recent),
+            'total_mean': sum(totals) / len(totals) if totals else 0.0,
+            'total_max': max(totals) if totals else 0.0,
+            'phases': {name: {'mean': sum(v) / len(self.recent), 'max': max(v), 'calls': len(v)}
+                       for name, v in phases.items()},
+            'rebuild_fraction': sum(record['rebuilt'] for record in self.recent) / max(len(self.recent), 1),
+        }
+        neighbors = [record['avg_neighbors'] for record in self.recent if 'avg_neighbors' in record]
+        if neighbors:
+            res['avg_neighbors'] = sum(neighbors) / len(neighbors)
+        for name in ('out_of_grid', 'neighbor_overflow'):
+            counts = [record[name] for record in self.recent if name in record]
+            if counts:
+                res[name + '_max'] = max(counts)
+        return res
+
+    def print_summary(self):
+        s = self.summary()
+        print('last %d steps: %.3f ms/step (max %.3f ms), rebuilt %.0f%% of steps' % (
+            s['steps'], s['total_mean'] * 1e3, s['total_max'] * 1e3, s['rebuild_fraction'] * 100))
+        for name, p in sorted(s['phases'].items(), key=lambda item: -item[1]['mean']):
+            share = p['mean'] / s['total_mean'] * 100 if s['total_mean'] > 0 else 0.0
+            print('  %-32s %9.3f ms/step %5.1f%%  max %9.3f ms' % (name, p['mean'] * 1e3, share, p['max'] * 1e3))
+        if 'avg_neighbors' in s:
+            print('  average neighbors per particle %.1f' % s['avg_neighbors'])
+        if s.get('out_of_grid_max', 0) > 0 or s.get('neighbor_overflow_max', 0) > 0:
+            print('  up to %d particles outside the grid, up to %d with truncated neighbor lists' % (
+                s.get('out_of_grid_max', 0), s.get('neighbor_overflow_max', 0)))
+        if self.kernel_profiler:
+            ti.profiler.print_kernel_profiler_info('count')
+
+    def clear(self):
+        self.recent.clear()
+        self.trace = []
+        if self.kernel_profiler:
+            ti.profiler.clear_kernel_profiler()
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'trace': self.trace}, f, indent=2)
@@ -4,79 +4,208 @@ import numpy as np
 
 @ti.data_oriented
 class SPHBase:
-    def __init__(self, particle_system):
+    def __init__(self, particle_system, adaptive_dt=False, kernel_table_size=0, viscosity=0.05, gravity=-9.80):
         self.ps = particle_system
-        self.g = -9.80  # Gravity
-        self.viscosity = 0.05  # viscosity
+        self.g = gravity  # Gravity
+        self.viscosity = viscosity  # viscosity
         self.density_0 = 1000.0  # reference density
         self.mass = self.ps.m_V * self.density_0
         self.dt = ti.field(float, shape=())
         self.dt[None] = 2e-4
+        self.time = 0.0  # simulated time
+
+        # Cubic spline kernel constants, W(r) = kernel_k * f(q) with q = r / h
+        h = self.ps.support_radius
+        self.inv_h = 1.0 / h
+        self.kernel_k = {1: 4 / 3, 2: 40 / 7 / np.pi, 3: 8 / np.pi}[self.ps.dim] / h ** self.ps.dim
+        self.kernel_l = 6. * self.kernel_k
+        # Optionally look W and dW/dq up from tables sampled over q in [0, 1] with linear interpolation
+        self.kernel_table_size = kernel_table_size
+        if self.kernel_table_size > 0:
+            self.kernel_table = ti.field(float, shape=self.kernel_table_size + 1)
+            self.kernel_derivative_table = ti.field(float, shape=self.kernel_table_size + 1)
+            q = np.linspace(0.0, 1.0, self.kernel_table_size + 1)
+            self.kernel_table.from_numpy(np.where(
+                q <= 0.5, self.kernel_k * (6.0 * q ** 3 - 6.0 * q ** 2 + 1), self.kernel_k * 2 * (1 - q) ** 3))
+            self.kernel_derivative_table.from_numpy(np.where(
+                q <= 0.5, self.kernel_l * q * (3.0 * q - 2.0), -self.kernel_l * (1 - q) ** 2))
+
+        # Adaptive time stepping (CFL condition)
+        self.adaptive_dt = adaptive_dt
+        self.cfl_factor = 0.4
+        self.dt_min = 1e-5
+        self.dt_max = 5e-3
+        # A step that would leave less than this fraction of dt before max_dt is stretched to land on it, see step
+        self.dt_snap = 1e-3
+        self.max_velocity = ti.field(float, shape=())
+        self.max_acceleration = ti.field(float, shape=())
+
+        # Batched scenes: gravity, viscosity and dt are read per particle from the parameters of its scene,
+        # set with set_scene_parameters. Scenes that are not active keep their state while the others advance.
+        self.scene_num = self.ps.scene_num
+        if self.scene_num > 1:
+            assert not self.adaptive_dt, 'adaptive time stepping is not supported with several scenes'
+            self.scene_gravity = ti.field(float, shape=self.scene_num)
+            self.scene_viscosity = ti.field(float, shape=self.scene_num)
+            self.scene_dt = ti.field(float, shape=self.scene_num)
+            self.scene_active = ti.field(int, shape=self.scene_num)
+            self.scene_gravity.fill(self.g)
+            self.scene_viscosity.fill(self.viscosity)
+            self.scene_dt.fill(self.dt[None])
+            self.scene_active.fill(1)
+            self.scene_time = np.zeros(self.scene_num)
+
+        self.d_velocity = ti.Vector.field(self.ps.dim, dtype=float)
+        self.ps.place_particle_fields(self.d_velocity)
+
+        # Instrumentation hooks, see profiler.StepProfiler for the interface
+        self.hooks = []
+        self.rebuilt = False  # whether the last step rebuilt the grid
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def run_phase(self, name, fn, *args):
+        # Call fn(*args) as the named phase of the step, reported to every hook
+        if not self.hooks:
+            return fn(*args)
+        for hook in self.hooks:
+            hook.begin_phase(self, name)
+        res = fn(*args)
+        for hook in reversed(self.hooks):
+            hook.end_phase(self, name)
+        return res
+
+    @ti.func
+    def kernel_table_lookup(self, table: ti.template(), q):
+        x = q * self.kernel_table_size
+        i = ti.min(ti.cast(x, int), self.kernel_table_size - 1)
+        t = x - i
+        return (1.0 - t) * table[i] + t * table[i + 1]
 
     @ti.func
     def cubic_kernel(self, r_norm):
         res = ti.cast(0.0, ti.f32)
-        h = self.ps.support_radius
         # value of cubic spline smoothing kernel
-        k = 1.0
-        if self.ps.dim == 1:
-            k = 4 / 3
-        elif self.ps.dim == 2:
-            k = 40 / 7 / np.pi
-        elif self.ps.dim == 3:
-            k = 8 / np.pi
-        k /= h ** self.ps.dim
-        q = r_norm / h
+        q = r_norm * self.inv_h
         if q <= 1.0:
-            if q <= 0.5:
+            if ti.static(self.kernel_table_size > 0):
+                res = self.kernel_table_lookup(self.kernel_table, q)
+            elif q <= 0.5:
                 q2 = q * q
                 q3 = q2 * q
-                res = k * (6.0 * q3 - 6.0 * q2 + 1)
+                res = self.kernel_k * (6.0 * q3 - 6.0 * q2 + 1)
             else:
-                res = k * 2 * ti.pow(1 - q, 3.0)
+                factor = 1.0 - q
+                res = self.kernel_k * 2 * factor * factor * factor
         return res
 
     @ti.func
     def cubic_kernel_derivative(self, r):
-        h = self.ps.support_radius
         # derivative of cubic spline smoothing kernel
-        k = 1.0
-        if self.ps.dim == 1:
-            k = 4 / 3
-        elif self.ps.dim == 2:
-            k = 40 / 7 / np.pi
-        elif self.ps.dim == 3:
-            k = 8 / np.pi
-        k = 6. * k / h ** self.ps.dim
         r_norm = r.norm()
-        q = r_norm / h
+        q = r_norm * self.inv_h
         res = ti.Vector([0.0 for _ in range(self.ps.dim)])
         if r_norm > 1e-5 and q <= 1.0:
-            grad_q = r / (r_norm * h)
-            if q <= 0.5:
-                res = k * q * (3.0 * q - 2.0) * grad_q
+            grad_q = r * (self.inv_h / r_norm)
+            if ti.static(self.kernel_table_size > 0):
+                res = self.kernel_table_lookup(self.kernel_derivative_table, q) * grad_q
+            elif q <= 0.5:
+                res = self.kernel_l * q * (3.0 * q - 2.0) * grad_q
             else:
                 factor = 1.0 - q
-                res = k * (-factor * factor) * grad_q
+                res = self.kernel_l * (-factor * factor) * grad_q
         return res
 
+    def set_scene_parameters(self, scene, gravity=None, viscosity=None, dt=None):
+        if gravity is not None:
+            self.scene_gravity[scene] = gravity
+        if viscosity is not None:
+            self.scene_viscosity[scene] = viscosity
+        if dt is not None:
+            self.scene_dt[scene] = dt
+
     @ti.func
-    def viscosity_force(self, p_i, p_j, r):
-        # Compute the viscosity force contribution
+    def gravity_of(self, p_i):
+        res = self.g
+        if ti.static(self.scene_num > 1):
+            res = self.scene_gravity[self.ps.scene_id[p_i]]
+        return res
+
+    @ti.func
+    def viscosity_of(self, p_i):
+        res = self.viscosity
+        if ti.static(self.scene_num > 1):
+            res = self.scene_viscosity[self.ps.scene_id[p_i]]
+        return res
+
+    @ti.func
+    def dt_of(self, p_i):
+        res = self.dt[None]
+        if ti.static(self.scene_num > 1):
+            res = self.scene_dt[self.ps.scene_id[p_i]]
+        return res
+
+    @ti.func
+    def is_moving(self, p_i):
+        # Fluid particle of an active scene
+        flag = self.ps.material[p_i] == self.ps.material_fluid
+        if ti.static(self.scene_num > 1):
+            flag = flag and self.scene_active[self.ps.scene_id[p_i]] != 0
+        return flag
+
+    @ti.func
+    def viscosity_scale(self, p_i, p_j, r):
+        # Viscosity force contribution divided by the kernel gradient
         v_xy = (self.ps.v[p_i] -
                 self.ps.v[p_j]).dot(r)
-        res = 2 * (self.ps.dim + 2) * self.viscosity * (self.mass / (self.ps.density[p_j])) * v_xy / (
-            r.norm()**2 + 0.01 * self.ps.support_radius**2) * self.cubic_kernel_derivative(
-                r)
-        return res
+        return 2 * (self.ps.dim + 2) * self.viscosity_of(p_i) * (self.mass / (self.ps.density[p_j])) * v_xy / (
+            r.norm()**2 + 0.01 * self.ps.support_radius**2)
+
+    @ti.func
+    def pressure_scale(self, p_i, p_j):
+        # Pressure force contribution divided by the kernel gradient, Symmetric Formula
+        return -self.density_0 * self.ps.m_V * (self.ps.pressure[p_i] / self.ps.density[p_i] ** 2
+                                                + self.ps.pressure[p_j] / self.ps.density[p_j] ** 2)
+
+    @ti.func
+    def viscosity_force(self, p_i, p_j, r):
+        # Compute the viscosity force contribution
+        return self.viscosity_scale(p_i, p_j, r) * self.cubic_kernel_derivative(r)
 
     @ti.func
     def pressure_force(self, p_i, p_j, r):
         # Compute the pressure force contribution, Symmetric Formula
-        res = -self.density_0 * self.ps.m_V * (self.ps.pressure[p_i] / self.ps.density[p_i] ** 2
-              + self.ps.pressure[p_j] / self.ps.density[p_j] ** 2) \
-              * self.cubic_kernel_derivative(r)
-        return res
+        return self.pressure_scale(p_i, p_j) * self.cubic_kernel_derivative(r)
+
+    @ti.func
+    def boundary_pressure_force(self, p_i, b, r):
+        # Pressure mirrored onto the boundary sample, Akinci et al. 2012
+        return -self.density_0 * self.ps.boundary_volume[b] * self.ps.pressure[p_i] / self.ps.density[p_i] ** 2 \
+            * self.cubic_kernel_derivative(r)
+
+    @ti.func
+    def compute_boundary_volume_task(self, b, k, ret: ti.template()):
+        if b != k:
+            ret += self.cubic_kernel((self.ps.boundary_x[b] - self.ps.boundary_x[k]).norm())
+
+    @ti.kernel
+    def compute_boundary_volumes(self):
+        # V_b = 1 / sum_k W(x_b - x_k) over the boundary samples, Akinci et al. 2012
+        for b in range(self.ps.boundary_num[None]):
+            delta = self.cubic_kernel(0.0)
+            self.ps.for_boundary_samples_near(self.ps.boundary_x[b], b, self.compute_boundary_volume_task, delta)
+            self.ps.boundary_volume[b] = 1.0 / delta
+
+    def update_boundary(self):
+        # The static boundary is binned and its volumes computed only after samples were added
+        if self.ps.boundary_dirty:
+            self.ps.build_boundary()
+            self.compute_boundary_volumes()
+            self.ps.boundary_dirty = False
 
     def substep(self):
         pass
@@ -113,7 +242,7 @@ class SPHBase:
             #                 p_i, ti.Vector([0.0, 1.0]),
             #                self.ps.padding - pos[1])
             if self.ps.dim == 3:
-                if self.ps.material[p_i] == self.ps.material_fluid:
+                if self.is_moving(p_i):
                     pos = self.ps.x[p_i]
                     if pos[0] < self.ps.padding:
                         self.simulate_collisions(
@@ -141,7 +270,85 @@ class SPHBase:
                             p_i, ti.Vector([0.0, 0.0, 1.0]),
                             self.ps.padding - pos[2])
 
-    def step(self):
-        self.ps.initialize_particle_system()
+    @ti.kernel
+    def compute_max_velocity_acceleration(self):
+        self.max_velocity[None] = 0.0
+        self.max_acceleration[None] = 0.0
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] == self.ps.material_fluid:
+                ti.atomic_max(self.max_velocity[None], self.ps.v[p_i].norm())
+                ti.atomic_max(self.max_acceleration[None], self.d_velocity[p_i].norm())
+
+    def compute_cfl_dt(self):
+        # dt from the CFL condition on the velocity, plus the analogous bound on the
+        # acceleration of the previous step, clamped to [dt_min, dt_max]
+        self.compute_max_velocity_acceleration()
+        dt = self.dt_max
+        length = self.ps.particle_diameter
+        max_v = self.max_velocity[None]
+        max_a = self.max_acceleration[None]
+        if max_v > 0.0:
+            dt = min(dt, self.cfl_factor * length / max_v)
+        if max_a > 0.0:
+            dt = min(dt, self.cfl_factor * np.sqrt(length / max_a))
+        return max(dt, self.dt_min)
+
+    def step(self, max_dt=None):
+        # max_dt caps this step so it lands on a frame boundary or the end time; batched scenes ignore it and
+        # keep their own dt, see simulate_scenes_until
+        for hook in self.hooks:
+            hook.begin_step(self)
+        self.run_phase('boundary_update', self.update_boundary)
+        # The grid and neighbor lists are rebuilt only when the Verlet skin has been used up
+        self.rebuilt = self.run_phase('rebuild_check', self.ps.need_rebuild)
+        if self.rebuilt:
+            self.run_phase('grid_build', self.ps.build_grid)
+            self.run_phase('neighbor_search', self.ps.build_neighbor_lists)
+        fixed_dt = None
+        if self.adaptive_dt:
+            dt = self.run_phase('cfl', self.compute_cfl_dt)
+        else:
+            dt = self.dt[None]
+        # Land exactly on max_dt also when the step falls just short of it: dt is rounded to f32 and would
+        # otherwise leave a sliver of a step at the end of most frames
+        if max_dt is not None and self.scene_num == 1 and max_dt < dt * (1 + self.dt_snap):
+            if not self.adaptive_dt:
+                # A fixed dt is changed for this step only
+                fixed_dt = dt
+            dt = max_dt
+        if self.adaptive_dt or fixed_dt is not None:
+            self.dt[None] = dt
         self.substep()
-        self.enforce_boundary()
+        self.run_phase('enforce_boundary', self.enforce_boundary)
+        if fixed_dt is not None:
+            self.dt[None] = fixed_dt
+        if self.scene_num > 1:
+            self.scene_time += self.scene_dt.to_numpy() * self.scene_active.to_numpy()
+            dt = self.scene_time.min() - self.time
+        self.time += dt
+        for hook in self.hooks:
+            hook.end_step(self)
+
+    def simulate_until(self, t_end):
+        # Step until the simulated time reaches t_end, returns the number of steps taken
+        if self.scene_num > 1:
+            return self.simulate_scenes_until(t_end)
+        step_num = 0
+        while self.time < t_end - 1e-9:
+            # Shorten the last step to land on t_end
+            self.step(max_dt=t_end - self.time)
+            step_num += 1
+        return step_num
+
+    def simulate_scenes_until(self, t_end):
+        # Batched scenes step together; a scene stops once one more step of its own dt would overshoot t_end
+        step_num = 0
+        while True:
+            active = self.scene_time + 0.5 * self.scene_dt.to_numpy() < t_end
+            if not active.any():
+                break
+            self.scene_active.from_numpy(active.astype(np.int32))
+            self.step()
+            step_num += 1
+        self.scene_active.fill(1)
+        return step_num
@@ -0,0 +1,275 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import struct
+import warnings
+
+import numpy as np
+import taichi as ti
+
+# Mesh file layout: MAGIC, u32 version, u32 vertex count, u32 triangle count, f32 vertices (n, 3),
+# u32 triangle indices (m, 3)
+MESH_MAGIC = b'SPHMESH\0'
+MESH_VERSION = 1
+
+# Kuhn decomposition of a cube into six tetrahedra around the diagonal 0-7, corner c at offset
+# (c & 1, (c >> 1) & 1, (c >> 2) & 1). Every tetrahedron edge joins a lower to a higher corner, so
+# neighboring cubes interpolate shared edges identically and the vertices can be welded exactly.
+TETRAHEDRA = [[0, 1, 3, 7], [0, 3, 2, 7], [0, 2, 6, 7], [0, 6, 4, 7], [0, 4, 5, 7], [0, 5, 1, 7]]
+
+
+@ti.data_oriented
+class SurfaceReconstructor:
+    # Splats particles onto a sparse voxel grid as the SPH density ratio sum_j m_V W(x - x_j), using the
+    # solver's cubic kernel, and extracts the iso-surface with a parallel marching tetrahedra kernel.
+    # Only 8^3 voxel blocks within one support radius of some particle are allocated. iso is a fraction of the
+    # field inside fluid at rest, so 0.5 is the surface of half full voxels.
+    def __init__(self, solver, voxel_size=None, iso=0.5, block_size=8, max_triangles=2 ** 20):
+        self.solver = solver
+        self.ps = solver.ps
+        assert self.ps.dim == 3
+        self.voxel_size = voxel_size or self.ps.particle_radius
+        self.iso = iso
+        self.block_size = block_size
+        self.shape = tuple(int(n) for n in np.ceil(np.asarray(self.ps.bound) / self.voxel_size) + 1)
+        block_num = tuple(-(-n // block_size) for n in self.shape)
+        self.phi = ti.field(float)
+        self.blocks = ti.root.pointer(ti.ijk, block_num)
+        self.blocks.dense(ti.ijk, block_size).place(self.phi)
+        self.triangle_num = ti.field(int, shape=())
+        self.max_triangles = max_triangles
+        self.triangles = ti.Vector.ndarray(3, ti.f32, shape=(max_triangles, 3))
+        self.full_value = self.calibrate()
+        self.level = iso * self.full_value
+
+    @ti.func
+    def in_grid(self, I):
+        flag = True
+        for d in ti.static(range(3)):
+            flag = flag and (0 <= I[d] < self.shape[d])
+        return flag
+
+    @ti.kernel
+    def splat(self, n: int, positions: ti.types.ndarray()):
+        r = ti.static(int(np.ceil(self.ps.support_radius / self.voxel_size)))
+        for p in range(n):
+            x = ti.Vector([positions[p, 0], positions[p, 1], positions[p, 2]])
+            base = ti.floor(x / self.voxel_size, int)
+            for offset in ti.grouped(ti.ndrange((-r, r + 2), (-r, r + 2), (-r, r + 2))):
+                I = base + offset
+                if self.in_grid(I):
+                    # Also touches voxels just outside the support, so every cube around the surface is allocated
+                    w = self.ps.m_V * self.solver.cubic_kernel((I * self.voxel_size - x).norm())
+                    ti.atomic_add(self.phi[I], w)
+
+    def calibrate(self):
+        # Mean field over one lattice cell inside a block of particles sampled the way add_cube does
+        spacing = self.ps.particle_radius * 2.8
+        k = int(np.ceil(self.ps.support_radius / spacing)) + 1
+        center = np.asarray(self.ps.bound, dtype=np.float64) / 2
+        offsets = np.arange(-k, k + 1) * spacing
+        lattice = np.stack(np.meshgrid(offsets, offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 3) + center
+        self.blocks.deactivate_all()
+        self.splat(len(lattice), np.ascontiguousarray(lattice, dtype=np.float32))
+        lo = np.ceil(center / self.voxel_size).astype(int)
+        hi = np.maximum(np.floor((center + spacing) / self.voxel_size).astype(int), lo)
+        values = [self.phi[i, j, l] for i in range(lo[0], hi[0] + 1) for j in range(lo[1], hi[1] + 1)
+                  for l in range(lo[2], hi[2] + 1)]
+        self.blocks.deactivate_all()
+        return float(np.mean(values))
+
+    @ti.func
+    def corner(self, I, c: ti.template()):
+        return I + ti.Vector([c & 1, (c >> 1) & 1, (c >> 2) & 1])
+
+    @ti.func
+    def edge_point(self, I, v, a: ti.template(), b: ti.template()):
+        # Crossing on the edge between cube corners a and b, always interpolated from the lower corner
+        lo = ti.static(min(a, b))
+        hi = ti.static(max(a, b))
+        t = (self.level - v[lo]) / (v[hi] - v[lo])
+        p_lo = self.corner(I, lo) * self.voxel_size
+        p_hi = self.corner(I, hi) * self.voxel_size
+        return p_lo + t * (p_hi - p_lo)
+
+    @ti.func
+    def emit(self, triangles: ti.template(), q0, q1, q2, outward):
+        # Stored so that the normal points out of the fluid
+        t = ti.atomic_add(self.triangle_num[None], 1)
+        if t < triangles.shape[0]:
+            triangles[t, 0] = q0
+            if (q1 - q0).cross(q2 - q0).dot(outward) < 0:
+                triangles[t, 1] = q2
+                triangles[t, 2] = q1
+            else:
+                triangles[t, 1] = q1
+                triangles[t, 2] = q2
+
+    @ti.kernel
+    def march(self, triangles: ti.types.ndarray()):
+        self.triangle_num[None] = 0
+        for I in ti.grouped(self.phi):
+            if self.in_grid(I + 1):
+                v = ti.Vector([self.phi[self.corner(I, c)] for c in range(8)])
+                for tet in ti.static(TETRAHEDRA):
+                    inside = 0
+                    inside_sum = ti.Vector.zero(float, 3)
+                    outside_sum = ti.Vector.zero(float, 3)
+                    for c in ti.static(tet):
+                        if v[c] > self.level:
+                            inside += 1
+                            inside_sum += self.corner(I, c) * self.voxel_size
+                        else:
+                            outside_sum += self.corner(I, c) * self.voxel_size
+                    # From the mean of the inside corners to the mean of the outside ones
+                    outward = outside_sum / ti.max(4 - inside, 1) - inside_sum / ti.max(inside, 1)
+                    if inside == 1 or inside == 3:
+                        # One corner on its own side: one triangle on its three edges
+                        for k in ti.static(range(4)):
+                            a = ti.static(tet[k])
+                            others = ti.static([tet[m] for m in range(4) if m != k])
+                            if (v[a] > self.level) == (inside == 1):
+                                self.emit(triangles, self.edge_point(I, v, a, others[0]),
+                                          self.edge_point(I, v, a, others[1]),
+                                          self.edge_point(I, v, a, others[2]), outward)
+                    elif inside == 2:
+                        # Two against two: a quad a-c, a-d, b-d, b-c split into two triangles
+                        for split in ti.static([(0, 1, 2, 3), (0, 2, 1, 3), (0, 3, 1, 2)]):
+                            a = ti.static(tet[split[0]])
+                            b = ti.static(tet[split[1]])
+                            c = ti.static(tet[split[2]])
+                            d = ti.static(tet[split[3]])
+                            if (v[a] > self.level) == (v[b] > self.level):
+                                q0 = self.edge_point(I, v, a, c)
+                                q1 = self.edge_point(I, v, a, d)
+                                q2 = self.edge_point(I, v, b, d)
+                                q3 = self.edge_point(I, v, b, c)
+                                self.emit(triangles, q0, q1, q2, outward)
+                                self.emit(triangles, q0, q2, q3, outward)
+
+    @ti.kernel
+    def max_value(self) -> float:
+        res = 0.0
+        for I in ti.grouped(self.phi):
+            ti.atomic_max(res, self.phi[I])
+        return res / self.full_value
+
+    def reconstruct(self, positions):
+        # Triangle mesh of the fluid surface around positions (n, 3): (vertices (v, 3) f32, indices (m, 3) u32)
+        positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, 3)
+        self.blocks.deactivate_all()
+        if len(positions) == 0:
+            return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.uint32)
+        self.splat(len(positions), positions)
+        self.march(self.triangles)
+        num = self.triangle_num[None]
+        if num > self.max_triangles:
+            self.max_triangles = max(num, 2 * self.max_triangles)
+            self.triangles = ti.Vector.ndarray(3, ti.f32, shape=(self.max_triangles, 3))
+            self.march(self.triangles)
+        if num == 0:
+            warnings.warn('no surface at iso %g in %d particles, the field peaks at %.3g of full' % (
+                self.iso, len(positions), self.max_value()), RuntimeWarning)
+        soup = self.triangles.to_numpy()[:num].reshape(-1, 3)
+        # Shared edges produce bit-identical points, so welding them is an exact unique
+        vertices, indices = np.unique(soup, axis=0, return_inverse=True)
+        indices = indices.reshape(-1, 3).astype(np.uint32)
+        # Triangles collapsed by a crossing exactly on a corner
+        keep = (indices[:, 0] != indices[:, 1]) & (indices[:, 1] != indices[:, 2]) & (indices[:, 0] != indices[:, 2])
+        return vertices.astype(np.float32), indices[keep]
+
+
+def write_mesh(path, vertices, indices):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MESH_MAGIC + struct.pack('<III', MESH_VERSION, len(vertices), len(indices)))
+        f.write(memoryview(np.ascontiguousarray(vertices, dtype=np.float32)))
+        f.write(memoryview(np.ascontiguousarray(indices, dtype=np.uint32)))
+    os.replace(tmp_path, path)
+
+
+def read_mesh(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MESH_MAGIC)) != MESH_MAGIC:
+            raise ValueError('%s is not an SPH mesh' % path)
+        version, vertex_num, triangle_num = struct.unpack('<III', f.read(12))
+        if version > MESH_VERSION:
+            raise ValueError('mesh version %d is newer than supported version %d' % (version, MESH_VERSION))
+        vertices = np.fromfile(f, dtype=np.float32, count=vertex_num * 3).reshape(-1, 3)
+        indices = np.fromfile(f, dtype=np.uint32, count=triangle_num * 3).reshape(-1, 3)
+    return vertices, indices
+
+
+_reconstructor = None
+
+
+def _init_worker(domain, threads, voxel_size, iso):
+    # One Taichi runtime and reconstructor per worker, reused for all of its frames
+    global _reconstructor
+    init_kwargs = {}
+    if threads is not None:
+        init_kwargs['cpu_max_num_threads'] = threads
+    ti.init(arch=ti.cpu, **init_kwargs)
+    from particle_system import ParticleSystem
+    from sph_base import SPHBase
+    # Only the kernel and the particle constants are needed
+    ps = ParticleSystem(tuple(domain), store_neighbors=False, particle_max_num=1)
+    _reconstructor = SurfaceReconstructor(SPHBase(ps), voxel_size=voxel_size, iso=iso)
+
+
+def mesh_frame(task):
+    frame_path, mesh_path = task
+    with np.load(frame_path) as data:
+        positions = data['position']
+        if 'material' in data:
+            positions = positions[data['material'] == _reconstructor.ps.material_fluid]
+    vertices, indices = _reconstructor.reconstruct(positions)
+    write_mesh(mesh_path, vertices, indices)
+    return mesh_path, len(vertices), len(indices)
+
+
+def mesh_frames(input_dir, output_dir, domain, workers=1, threads_per_worker=None, voxel_size=None, iso=0.5,
+                overwrite=False, verbose=True):
+    # Meshes every frame_#####.npz written by FrameExporter into mesh_#####.bin. Frames already meshed are
+    # skipped, so this can be rerun alongside a simulation that is still writing frames.
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = []
+    for frame_path in sorted(glob.glob(os.path.join(input_dir, 'frame_*.npz'))):
+        name = os.path.basename(frame_path).replace('frame_', 'mesh_').replace('.npz', '.bin')
+        mesh_path = os.path.join(output_dir, name)
+        if overwrite or not os.path.exists(mesh_path):
+            tasks.append((frame_path, mesh_path))
+    if not tasks:
+        return []
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(domain, threads_per_worker, voxel_size, iso)) as pool:
+        for mesh_path, vertex_num, triangle_num in pool.imap_unordered(mesh_frame, tasks):
+            if verbose:
+                print('%s: %d vertices, %d triangles' % (mesh_path, vertex_num, triangle_num))
+            results.append(mesh_path)
+    return results
+
+
+def main():
+    from headless import load_scene
+
+    parser = argparse.ArgumentParser(description='Reconstruct fluid surface meshes from exported frames')
+    parser.add_argument('input', help='directory with frame_#####.npz files')
+    parser.add_argument('output', help='directory for mesh_#####.bin files')
+    parser.add_argument('--scene', help='JSON scene config the frames were simulated with, for the domain')
+    parser.add_argument('--workers', type=int, default=1, help='frames meshed in parallel')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per worker (default: cores / workers)')
+    parser.add_argument('--voxel-size', type=float, default=None, help='grid spacing (default: particle radius)')
+    parser.add_argument('--iso', type=float, default=0.5, help='iso value as a fraction of the field inside fluid at rest')
+    parser.add_argument('--overwrite', action='store_true', help='remesh frames that already have a mesh')
+    args = parser.parse_args()
+
+    threads = args.threads or max(os.cpu_count() // args.workers, 1)
+    mesh_frames(args.input, args.output, load_scene(args.scene)['domain'], args.workers, threads, args.voxel_size,
+                args.iso, args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from headless import load_scene
+
+RESULTS_FILE = 'results.jsonl'
+TABLE_FILE = 'results.csv'
+
+
+def expand_grid(grid):
+    # {'stiffness': [50, 100], 'viscosity': [0.05]} -> every combination as a list of dicts
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_config(scene, params, total_time, frame_dt):
+    # Everything the result of a run depends on: the scene with params merged into its solver kwargs, and the
+    # simulated times, so a sweep resumed with another scene or --time reruns instead of reusing old results
+    scene = dict(scene)
+    scene['solver'] = dict(scene['solver'], **params)
+    return {'scene': scene, 'total_time': total_time, 'frame_dt': frame_dt or scene['frame_dt']}
+
+
+def run_id(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _init_worker(threads, arch):
+    # Every worker is its own Taichi runtime with a fixed share of the cores
+    import taichi as ti
+    init_kwargs = {}
+    if threads is not None:
+        init_kwargs['cpu_max_num_threads'] = threads
+    ti.init(arch=getattr(ti, arch), **init_kwargs)
+
+
+def measure(ps, solver):
+    # Average relative density error of the fluid and its kinetic energy
+    n = ps.particle_num[None]
+    density = np.empty(n, dtype=np.float64)
+    ps.copy_to_numpy(density, ps.density)
+    material = np.empty(n, dtype=np.int32)
+    ps.copy_to_numpy(material, ps.material)
+    velocity = np.empty((n, ps.dim), dtype=np.float32)
+    ps.copy_to_numpy_nd(velocity, ps.v)
+    fluid = material == ps.material_fluid
+    density_error = float(np.mean(np.abs(density[fluid] / solver.density_0 - 1.0))) if fluid.any() else 0.0
+    kinetic_energy = float(0.5 * solver.mass * np.sum(velocity[fluid].astype(np.float64) ** 2))
+    return density_error, kinetic_energy
+
+
+def run_one(task):
+    # Worker entry point: one headless simulation of the scene with params passed to the solver
+    import taichi as ti
+    from headless import build_scene
+
+    scene, params, total_time, frame_dt = task
+    config = run_config(scene, params, total_time, frame_dt)
+    scene, frame_dt = config['scene'], config['frame_dt']
+    result = {'id': run_id(config), 'params': params, 'total_time': total_time, 'frame_dt': frame_dt}
+    try:
+        start = time.perf_counter()
+        ps, solver = build_scene(scene)
+        errors = []
+        steps = 0
+        while solver.time < total_time - 1e-9:
+            steps += solver.simulate_until(min(solver.time + frame_dt, total_time))
+            density_error, kinetic_energy = measure(ps, solver)
+            errors.append(density_error)
+            if not np.isfinite(kinetic_energy):
+                raise FloatingPointError('simulation diverged at t %.4f' % solver.time)
+        ti.sync()
+        result.update({
+            'status': 'ok',
+            'simulated_time': solver.time,
+            'steps': steps,
+            'particles': int(ps.particle_num[None]),
+            'density_error_mean': float(np.mean(errors)) if errors else 0.0,
+            'density_error_max': float(np.max(errors)) if errors else 0.0,
+            'kinetic_energy': kinetic_energy if errors else 0.0,
+            'wall_time': time.perf_counter() - start,
+        })
+    except Exception as e:
+        result.update({'status': 'failed', 'error': repr(e)})
+    return result
+
+
+def load_results(output_dir):
+    path = os.path.join(output_dir, RESULTS_FILE)
+    results = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    r = json.loads(line)
+                    results[r['id']] = r
+    return results
+
+
+def write_table(output_dir, results, param_names):
+    columns = ['id'] + param_names + ['status', 'density_error_mean', 'density_error_max', 'kinetic_energy',
+                                      'wall_time', 'steps', 'particles']
+    with open(os.path.join(output_dir, TABLE_FILE), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for r in results:
+            row = dict(r, **r['params'])
+            writer.writerow([row.get(c, '') for c in columns])
+
+
+def sweep(scene, param_sets, total_time, output_dir, workers=1, threads_per_worker=None, arch='cpu', frame_dt=None,
+          retry_failed=False, verbose=True):
+    # Runs every parameter set in a pool of worker processes. Results are appended to results.jsonl as they
+    # arrive, so an interrupted sweep resumes with the runs that are missing.
+    os.makedirs(output_dir, exist_ok=True)
+    done = load_results(output_dir)
+    if retry_failed:
+        done = {k: r for k, r in done.items() if r['status'] == 'ok'}
+    ids = [run_id(run_config(scene, params, total_time, frame_dt)) for params in param_sets]
+    todo = [params for params, i in zip(param_sets, ids) if i not in done]
+    if verbose:
+        print('%d runs, %d done, %d to go' % (len(param_sets), len(param_sets) - len(todo), len(todo)))
+    if todo:
+        # Taichi's runtime does not survive a fork, and a fresh process per run keeps the fields of one
+        # run from piling up in the next
+        ctx = multiprocessing.get_context('spawn')
+        tasks = [(scene, params, total_time, frame_dt) for params in todo]
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(threads_per_worker, arch),
+                      maxtasksperchild=1) as pool, \
+                open(os.path.join(output_dir, RESULTS_FILE), 'a') as f:
+            for result in pool.imap_unordered(run_one, tasks):
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                done[result['id']] = result
+                if verbose:
+                    print('%s %s %s' % (result['id'], json.dumps(result['params'], sort_keys=True), result['status']))
+    results = [done[i] for i in ids]
+    param_names = sorted({name for params in param_sets for name in params})
+    write_table(output_dir, results, param_names)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep WCSPH solver parameters over headless runs')
+    parser.add_argument('params', help='JSON file: a list of solver kwargs dicts, or a dict of value lists for a grid')
+    parser.add_argument('--scene', help='JSON scene config, keys as in headless.DEFAULT_SCENE')
+    parser.add_argument('--output', required=True, help='directory for results.jsonl and results.csv')
+    parser.add_argument('--workers', type=int, default=1, help='simulations run in parallel')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='CPU threads per worker (default: cores / workers)')
+    parser.add_argument('--arch', default='cpu', choices=['cpu', 'gpu', 'cuda', 'vulkan', 'metal', 'opengl'])
+    parser.add_argument('--time', type=float, default=1.0, help='simulated end time in seconds')
+    parser.add_argument('--frame-dt', type=float, default=None, help='simulated time between measurements')
+    parser.add_argument('--retry-failed', action='store_true', help='rerun runs recorded as failed')
+    args = parser.parse_args()
+
+    with open(args.params) as f:
+        params = json.load(f)
+    param_sets = expand_grid(params) if isinstance(params, dict) else params
+    threads = args.threads
+    if threads is None and args.arch == 'cpu':
+        threads = max(os.cpu_count() // args.workers, 1)
+    results = sweep(load_scene(args.scene), param_sets, args.time, args.output, args.workers, threads, args.arch,
+                    args.frame_dt, args.retry_failed)
+    failed = sum(r['status'] != 'ok' for r in results)
+    print('%d runs, %d failed, table in %s' % (len(results), failed, os.path.join(args.output, TABLE_FILE)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,69 +2,177 @@ import taichi as ti
 from sph_base import SPHBase
 
 class WCSPHSolver(SPHBase):
-    def __init__(self, particle_system):
-        super().__init__(particle_system)
+    def __init__(self, particle_system, fused=False, symmetric=False, stiffness=50.0, exponent=7.0, **kwargs):
+        super().__init__(particle_system, **kwargs)
         # Pressure state function parameters(WCSPH)
-        self.exponent = 7.0
-        self.stiffness = 50.0
+        self.exponent = exponent
+        self.stiffness = stiffness
+        # Run the substep as two kernels, densities + pressure and forces + advection
+        self.fused = fused
+        # Evaluate every particle pair once and apply the force to both sides
+        self.symmetric = symmetric
+        if self.scene_num > 1:
+            self.scene_stiffness = ti.field(float, shape=self.scene_num)
+            self.scene_stiffness.fill(self.stiffness)
 
-        self.d_velocity = ti.Vector.field(self.ps.dim, dtype=float)
-        particle_node = ti.root.dense(ti.i, self.ps.particle_max_num)
-        particle_node.place(self.d_velocity)
+    def set_scene_parameters(self, scene, stiffness=None, **kwargs):
+        super().set_scene_parameters(scene, **kwargs)
+        if stiffness is not None:
+            self.scene_stiffness[scene] = stiffness
+
+    @ti.func
+    def stiffness_of(self, p_i):
+        res = self.stiffness
+        if ti.static(self.scene_num > 1):
+            res = self.scene_stiffness[self.ps.scene_id[p_i]]
+        return res
+
+    @ti.func
+    def compute_densities_task(self, p_i, p_j, ret: ti.template()):
+        x_i = self.ps.x[p_i]
+        x_j = self.ps.x[p_j]
+        ret += self.ps.m_V * self.cubic_kernel((x_i - x_j).norm())
+
+    @ti.func
+    def compute_boundary_densities_task(self, p_i, b, ret: ti.template()):
+        ret += self.ps.boundary_volume[b] * self.cubic_kernel((self.ps.x[p_i] - self.ps.boundary_x[b]).norm())
 
     @ti.kernel
     def compute_densities(self):
         for p_i in range(self.ps.particle_num[None]):
-            x_i = self.ps.x[p_i]
-            self.ps.density[p_i] = 0.0
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                x_j = self.ps.x[p_j]
-                self.ps.density[p_i] += self.ps.m_V * self.cubic_kernel((x_i - x_j).norm())
-            self.ps.density[p_i] *= self.density_0
+            density = 0.0
+            self.ps.for_all_neighbors(p_i, self.compute_densities_task, density)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_densities_task, density)
+            self.ps.density[p_i] = density * self.density_0
+
+    @ti.func
+    def compute_pressure_forces_task(self, p_i, p_j, ret: ti.template()):
+        x_i = self.ps.x[p_i]
+        x_j = self.ps.x[p_j]
+        # Compute Pressure force contribution
+        ret += self.pressure_force(p_i, p_j, x_i - x_j)
+
+    @ti.func
+    def compute_boundary_pressure_forces_task(self, p_i, b, ret: ti.template()):
+        ret += self.boundary_pressure_force(p_i, b, self.ps.x[p_i] - self.ps.boundary_x[b])
 
     @ti.kernel
     def compute_pressure_forces(self):
         for p_i in range(self.ps.particle_num[None]):
             self.ps.density[p_i] = ti.max(self.ps.density[p_i], self.density_0)
-            self.ps.pressure[p_i] = self.stiffness * (ti.pow(self.ps.density[p_i] / self.density_0, self.exponent) - 1.0)
+            self.ps.pressure[p_i] = self.stiffness_of(p_i) * (
+                ti.pow(self.ps.density[p_i] / self.density_0, self.exponent) - 1.0)
         for p_i in range(self.ps.particle_num[None]):
             if self.ps.material[p_i] != self.ps.material_fluid:
                 continue
-            x_i = self.ps.x[p_i]
             d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                x_j = self.ps.x[p_j]
-                # Compute Pressure force contribution
-                d_v += self.pressure_force(p_i, p_j, x_i-x_j)
+            self.ps.for_all_neighbors(p_i, self.compute_pressure_forces_task, d_v)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_pressure_forces_task, d_v)
             self.d_velocity[p_i] += d_v
 
+    @ti.func
+    def compute_non_pressure_forces_task(self, p_i, p_j, ret: ti.template()):
+        x_i = self.ps.x[p_i]
+        x_j = self.ps.x[p_j]
+        ret += self.viscosity_force(p_i, p_j, x_i - x_j)
+
     @ti.kernel
     def compute_non_pressure_forces(self):
         for p_i in range(self.ps.particle_num[None]):
             if self.ps.material[p_i] != self.ps.material_fluid:
                 continue
-            x_i = self.ps.x[p_i]
             # Add body force
             d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
-            d_v[1] = self.g  # Y轴
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                x_j = self.ps.x[p_j]
-                d_v += self.viscosity_force(p_i, p_j, x_i - x_j)
+            d_v[1] = self.gravity_of(p_i)  # Y轴
+            self.ps.for_all_neighbors(p_i, self.compute_non_pressure_forces_task, d_v)
             self.d_velocity[p_i] = d_v
 
     @ti.kernel
     def advect(self):
         # Symplectic Euler
         for p_i in range(self.ps.particle_num[None]):
+            if self.is_moving(p_i):
+                dt = self.dt_of(p_i)
+                self.ps.v[p_i] += dt * self.d_velocity[p_i]
+                self.ps.x[p_i] += dt * self.ps.v[p_i]
+
+    @ti.kernel
+    def compute_densities_and_pressure(self):
+        for p_i in range(self.ps.particle_num[None]):
+            density = 0.0
+            self.ps.for_all_neighbors(p_i, self.compute_densities_task, density)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_densities_task, density)
+            density = ti.max(density * self.density_0, self.density_0)
+            self.ps.density[p_i] = density
+            self.ps.pressure[p_i] = self.stiffness_of(p_i) * (ti.pow(density / self.density_0, self.exponent) - 1.0)
+
+    @ti.func
+    def compute_forces_task(self, p_i, p_j, ret: ti.template()):
+        r = self.ps.x[p_i] - self.ps.x[p_j]
+        # Viscosity and pressure share the kernel gradient
+        scale = self.viscosity_scale(p_i, p_j, r) + self.pressure_scale(p_i, p_j)
+        ret += scale * self.cubic_kernel_derivative(r)
+
+    @ti.kernel
+    def compute_forces_and_advect(self):
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_fluid:
+                continue
+            # Add body force
+            d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
+            d_v[1] = self.gravity_of(p_i)  # Y轴
+            self.ps.for_all_neighbors(p_i, self.compute_forces_task, d_v)
+            self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_pressure_forces_task, d_v)
+            self.d_velocity[p_i] = d_v
+        # Symplectic Euler
+        for p_i in range(self.ps.particle_num[None]):
+            if self.is_moving(p_i):
+                dt = self.dt_of(p_i)
+                self.ps.v[p_i] += dt * self.d_velocity[p_i]
+                self.ps.x[p_i] += dt * self.ps.v[p_i]
+
+    @ti.func
+    def compute_symmetric_forces_task(self, p_i, p_j, ret: ti.template()):
+        # Each pair is handled from one side only: p_j > p_i, or p_j a boundary particle, which has no
+        # neighbor list of its own
+        if p_j > p_i or self.ps.material[p_j] == self.ps.material_boundary:
+            r = self.ps.x[p_i] - self.ps.x[p_j]
+            grad = self.cubic_kernel_derivative(r)
+            # The pressure term is symmetric in i and j. The viscosity term carries 1 / density of the other
+            # particle, so the reaction on p_j is rescaled by density_j / density_i.
+            pressure = self.pressure_scale(p_i, p_j)
+            viscosity = self.viscosity_scale(p_i, p_j, r)
+            if self.ps.material[p_i] == self.ps.material_fluid:
+                ti.atomic_add(self.d_velocity[p_i], (pressure + viscosity) * grad)
+            if self.ps.material[p_j] == self.ps.material_fluid:
+                ti.atomic_add(self.d_velocity[p_j], -(pressure + viscosity * self.ps.density[p_j]
+                                                      / self.ps.density[p_i]) * grad)
+
+    @ti.kernel
+    def compute_symmetric_forces(self):
+        # Same forces as compute_non_pressure_forces + compute_pressure_forces with half the pair evaluations;
+        # densities and pressures come from compute_densities_and_pressure
+        for p_i in range(self.ps.particle_num[None]):
+            d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
             if self.ps.material[p_i] == self.ps.material_fluid:
-                self.ps.v[p_i] += self.dt[None] * self.d_velocity[p_i]
-                self.ps.x[p_i] += self.dt[None] * self.ps.v[p_i]
+                d_v[1] = self.gravity_of(p_i)  # Y轴
+                self.ps.for_all_boundary_neighbors(p_i, self.compute_boundary_pressure_forces_task, d_v)
+            self.d_velocity[p_i] = d_v
+        for p_i in range(self.ps.particle_num[None]):
+            if self.ps.material[p_i] != self.ps.material_boundary:
+                unused = 0.0
+                self.ps.for_all_neighbors(p_i, self.compute_symmetric_forces_task, unused)
 
     def substep(self):
-        self.compute_densities()
-        self.compute_non_pressure_forces()
-        self.compute_pressure_forces()
-        self.advect()
+        if self.symmetric:
+            self.run_phase('compute_densities_and_pressure', self.compute_densities_and_pressure)
+            self.run_phase('compute_symmetric_forces', self.compute_symmetric_forces)
+            self.run_phase('advect', self.advect)
+        elif self.fused:
+            self.run_phase('compute_densities_and_pressure', self.compute_densities_and_pressure)
+            self.run_phase('compute_forces_and_advect', self.compute_forces_and_advect)
+        else:
+            self.run_phase('compute_densities', self.compute_densities)
+            self.run_phase('compute_non_pressure_forces', self.compute_non_pressure_forces)
+            self.run_phase('compute_pressure_forces', self.compute_pressure_forces)
+            self.run_phase('advect', self.advect)
@@ -1,31 +1,148 @@
+import argparse
+import math
+import sys
 import time
 
 import taichi as ti
 
+from fluid.prefix_sum import PrefixSumExecutor
+
 ti.init(arch=ti.cuda)
 
 
+@ti.data_oriented
+class BallGrid:
+    # The balls of a list counting-sorted into the buckets of a hashed uniform grid whose cells are one contact
+    # distance of the largest balls wide, so only the 27 cells around a ball can hold balls touching it.
+    # Every build sizes the buckets to the balls it bins, so its cost follows the list, not the whole system.
+    def __init__(self, system, capacity):
+        self.system = system
+        max_bucket_num = 1 << (2 * capacity - 1).bit_length()
+        self.bucket_num = ti.field(int, shape=())  # power of two, at least two buckets per ball
+        # After the prefix sum bucket_count[b] is the end offset of bucket b in sorted_balls
+        self.bucket_count = ti.field(int, shape=max_bucket_num)
+        self.bucket_count_temp = ti.field(int, shape=max_bucket_num)
+        self.ball_bucket = ti.field(int, shape=capacity)
+        self.sorted_balls = ti.field(int, shape=capacity)
+        self.prefix_sum_executor = PrefixSumExecutor(max_bucket_num)
+
+    @ti.func
+    def cell_to_bucket(self, cell):
+        # Spatial hash of the unbounded lattice of cells (Teschner et al. 2003)
+        primes = ti.static([73856093, 19349663, 83492791])
+        h = ti.u32(0)
+        for d in ti.static(range(3)):
+            h ^= ti.cast(cell[d], ti.u32) * ti.u32(primes[d])
+        return ti.cast(h & ti.cast(self.bucket_num[None] - 1, ti.u32), int)
+
+    @ti.func
+    def bucket_start(self, bucket):
+        start = 0
+        if bucket > 0:
+            start = self.bucket_count[bucket - 1]
+        return start
+
+    @ti.kernel
+    def count_balls(self, balls: ti.template(), num: int):
+        for b in range(self.bucket_num[None]):
+            self.bucket_count[b] = 0
+        for k in range(num):
+            bucket = self.cell_to_bucket(self.system.pos_to_cell(self.system.pos[self.system.ball(balls[k])]))
+            self.ball_bucket[k] = bucket
+            ti.atomic_add(self.bucket_count[bucket], 1)
+
+    @ti.kernel
+    def sort_balls(self, balls: ti.template(), num: int):
+        for b in range(self.bucket_num[None]):
+            self.bucket_count_temp[b] = self.bucket_count[b]
+        for k in range(num):
+            offset = ti.atomic_sub(self.bucket_count_temp[self.ball_bucket[k]], 1) - 1
+            self.sorted_balls[offset] = balls[k]
+
+    def build(self, balls, num):
+        # Bins the first num balls of the list balls
+        bucket_num = 1 << (2 * max(num, 1) - 1).bit_length()
+        self.bucket_num[None] = bucket_num
+        self.count_balls(balls, num)
+        self.prefix_sum_executor.run(self.bucket_count, bucket_num)
+        self.sort_balls(balls, num)
+
+
 @ti.data_oriented
 class ParticleSystem:
-    def __init__(self, n: int, r: float):
+    # sleep_state values; WOKEN marks a ball woken during the current step, awake from the next one on
+    AWAKE = 0
+    ASLEEP = 1
+    WOKEN = 3
+    def __init__(self, n: int, r: float, min_r: float = None, density: float = 1.0, broad_phase: str = 'grid',
+                 sleep_velocity: float = 0.1, sleep_steps: int = 60, sleep_distance: float = None,
+                 floor_friction: float = 2.0):
         self.n = n
         self.pos = ti.Vector.field(3, float, shape=(n, n))
         self.vel = ti.Vector.field(3, float, shape=(n, n))
-        # self.mass = ti.Vector.field(3, float, shape=(n, n))
+        # Radii are drawn uniformly from [min_r, r], masses follow from density
+        self.radii = ti.field(float, shape=(n, n))
+        self.mass = ti.field(float, shape=(n, n))
+        self.inv_mass = ti.field(float, shape=(n, n))
+        self.dv = ti.Vector.field(3, float, shape=(n, n))
         self.vertices = ti.Vector.field(3, float, shape=n * n)
+        self.vertex_radii = ti.field(float, shape=n * n)
         self.gravity = ti.Vector([0, -9.8, 0])
         self.dt = 4e-2 / self.n
         self.reflact_factor = 0.9
+        # Rate, per second, at which the floor slows balls sliding on it
+        self.floor_friction = floor_friction
+        # Between balls; 0 removes the approaching relative velocity, 1 is an elastic bounce
+        self.restitution = 0.0
         self.drag_factor = -0.05
 
         self.radius = r
+        self.min_radius = r if min_r is None else min_r
+        self.density = density
+        self.contact_margin = 0.001
         self.scene_size = 20
-
-        self.quad_size = self.scene_size * 2 / 10
-        # self.zone = [[]]*100
-        self.zone = ti.Matrix.field(n=n, m=3, dtype=float, shape=(n, n))
-        self.zone_num = ti.field(int, shape=(n, n))
-
+        self.num = n * n
+
+        # 'grid': balls are binned in a BallGrid.
+        # 'sap': sweep and prune, balls sorted by the low end of their x extent are scanned forward until the
+        # extents stop overlapping; its cost does not depend on the largest ball, for wide size distributions.
+        # Either way awake and sleeping balls are kept apart: the awake ones are binned or sorted every step, the
+        # sleeping ones only when a ball falls asleep or wakes up.
+        assert broad_phase in ('grid', 'sap')
+        self.broad_phase = broad_phase
+        self.cell_size = 2 * self.radius + self.contact_margin
+        if broad_phase == 'grid':
+            self.awake_grid = BallGrid(self, self.num)
+            self.sleep_grid = BallGrid(self, self.num)
+        else:
+            # Sorted sleeping balls, padded with infinite keys
+            self.sleep_keys = ti.field(float, shape=self.num)
+            self.sleep_sweep_balls = ti.field(int, shape=self.num)
+            # Sort buffers for the awake balls by power of two length, see sweep_buffers
+            self._sweep_buffers = {}
+
+        # Sleeping: a ball resting on the floor or on other balls that stays within sleep_distance of where it
+        # came to rest for sleep_steps steps in a row stops being integrated and only stands in the broad phase as
+        # a fixed obstacle. Displacement instead of speed, so balls jittering in a pile still fall asleep.
+        # An awake ball faster than sleep_velocity wakes every sleeping ball it touches, so a disturbed pile wakes
+        # up contact by contact. sleep_steps = 0 disables sleeping.
+        self.sleep_velocity = sleep_velocity
+        self.sleep_steps = sleep_steps
+        self.sleep_distance = 0.25 * self.min_radius if sleep_distance is None else sleep_distance
+        self.sleep_state = ti.field(int, shape=(n, n))
+        self.still_steps = ti.field(int, shape=(n, n))
+        self.rest_anchor = ti.Vector.field(3, float, shape=(n, n))
+        self.in_contact = ti.field(int, shape=(n, n))  # touched another ball this step
+        # Awake balls of the current step, compacted at its start; balls woken during the step are appended
+        self.active_balls = ti.field(int, shape=self.num)
+        self.active_temp = ti.field(int, shape=self.num)
+        self.active_num = ti.field(int, shape=())
+        # Sleeping balls as of the last time a ball fell asleep or woke up, which sets sleep_changed
+        self.sleeping_balls = ti.field(int, shape=self.num)
+        self.sleeping_num = ti.field(int, shape=())
+        self.sleep_changed = ti.field(int, shape=())
+
+        self.initialize_sizes()
         self.initialize_mass_points()
         self.wind_on = ti.field(int, shape=())
         self.wind_on[None] = 0
@@ -36,10 +153,19 @@ class ParticleSystem:
             self.wind_on[None] = 1
         else:
             self.wind_on[None] = 0
+        self.wake_all()
 
         print(self.wind_on)
 
 
+    @ti.kernel
+    def initialize_sizes(self):
+        for i, j in self.radii:
+            r = self.min_radius + ti.random() * (self.radius - self.min_radius)
+            self.radii[i, j] = r
+            self.mass[i, j] = self.density * 4 / 3 * math.pi * r ** 3
+            self.inv_mass[i, j] = 1 / self.mass[i, j]
+
     @ti.kernel
     def initialize_mass_points(self):
 
@@ -51,55 +177,283 @@ class ParticleSystem:
                               ]
 
             self.vel[i, j] = [0, 0, 0]
+            self.reset_sleep(i * self.n + j)
+        self.active_num[None] = self.num
+        self.sleep_changed[None] = 1
+
+    @ti.kernel
+    def initialize_column(self, side: int):
+        # Balls stacked side x side per layer, the lowest layer just above the floor
+        spacing = 2 * self.radius + self.contact_margin
+        for i, j in self.pos:
+            p = i * self.n + j
+            layer = p // (side * side)
+            k = p % (side * side)
+            self.pos[i, j] = [(k // side - side / 2) * spacing, 0.01 + self.radius + layer * spacing,
+                              (k % side - side / 2) * spacing]
+            self.vel[i, j] = [0, 0, 0]
+            self.reset_sleep(p)
+        self.active_num[None] = self.num
+        self.sleep_changed[None] = 1
+
+    @ti.func
+    def reset_sleep(self, p):
+        I = self.ball(p)
+        self.sleep_state[I] = self.AWAKE
+        self.still_steps[I] = 0
+        self.rest_anchor[I] = self.pos[I]
+        self.active_balls[p] = p
+
+    @ti.kernel
+    def wake_all(self):
+        for p in range(self.num):
+            self.reset_sleep(p)
+        self.active_num[None] = self.num
+        self.sleep_changed[None] = 1
+
+    @ti.kernel
+    def awake_count(self) -> int:
+        count = 0
+        for I in ti.grouped(self.sleep_state):
+            if self.sleep_state[I] != self.ASLEEP:
+                count += 1
+        return count
 
     @ti.kernel
     def update_vertices(self):
         for i, j in ti.ndrange(self.n, self.n):
             self.vertices[i * self.n + j] = self.pos[i, j]
+            self.vertex_radii[i * self.n + j] = self.radii[i, j]
 
-    # @ti.func
-    # def set_zone(self):
-    #     for i, j in self.zone_num:
-    #         self.zone_num[i, j] = 0
-    #
-    #     for i in ti.grouped(self.pos):
-    #         x = self.pos[i][0]
-    #         z = self.pos[i][2]
-    #         x_index = ti.cast(ti.max((x + self.scene_size) % self.quad_size, 9), ti.int32)
-    #         z_index = ti.cast(ti.max((x + self.scene_size) % self.quad_size, 9), ti.int32)
-    #
-    #         # self.zone[x_index * 10 + z_index].append(self.pos[i])
-    #         count = self.zone_num[x_index, z_index]
-    #         for j in ti.static(range(3)):
-    #             self.zone[x_index, z_index][ti.static(count), j] = self.pos[i][j]
-    #
-    #         self.zone_num[x_index, z_index] += 1
+    @ti.func
+    def ball(self, p):
+        # (i, j) of the p-th ball in the n x n fields
+        return ti.Vector([p // self.n, p % self.n])
+
+    @ti.func
+    def pos_to_cell(self, pos):
+        return ti.floor(pos / self.cell_size, int)
 
     @ti.kernel
-    def take_step(self):
-        for i in ti.grouped(self.vel):
+    def collect_awake(self):
+        # Compacts the active list of the last step: balls that fell asleep leave, balls woken during it stay
+        num = self.active_num[None]
+        self.active_num[None] = 0
+        for k in range(num):
+            p = self.active_balls[k]
+            I = self.ball(p)
+            if self.sleep_state[I] == self.WOKEN:
+                self.sleep_state[I] = self.AWAKE
+            if self.sleep_state[I] == self.AWAKE:
+                self.active_temp[ti.atomic_add(self.active_num[None], 1)] = p
+        for k in range(self.active_num[None]):
+            self.active_balls[k] = self.active_temp[k]
+
+    @ti.kernel
+    def collect_asleep(self):
+        self.sleeping_num[None] = 0
+        for p in range(self.num):
+            if self.sleep_state[self.ball(p)] == self.ASLEEP:
+                self.sleeping_balls[ti.atomic_add(self.sleeping_num[None], 1)] = p
+
+    @ti.kernel
+    def sleep_sweep_prepare(self):
+        for k in range(self.num):
+            if k < self.sleeping_num[None]:
+                p = self.sleeping_balls[k]
+                I = self.ball(p)
+                self.sleep_keys[k] = self.pos[I][0] - self.radii[I]
+                self.sleep_sweep_balls[k] = p
+            else:
+                self.sleep_keys[k] = ti.math.inf
+                self.sleep_sweep_balls[k] = -1
+
+    def build_sleeping(self):
+        self.collect_asleep()
+        if self.broad_phase == 'grid':
+            self.sleep_grid.build(self.sleeping_balls, self.sleeping_num[None])
+        else:
+            self.sleep_sweep_prepare()
+            ti.algorithms.parallel_sort(self.sleep_keys, self.sleep_sweep_balls)
+
+    @ti.func
+    def wake(self, p):
+        # Only the first of several balls waking p at once appends it to the active list
+        I = self.ball(p)
+        if ti.atomic_or(self.sleep_state[I], self.WOKEN) == self.ASLEEP:
+            self.still_steps[I] = 0
+            self.rest_anchor[I] = self.pos[I]
+            self.active_balls[ti.atomic_add(self.active_num[None], 1)] = p
+            self.sleep_changed[None] = 1
+
+    @ti.kernel
+    def apply_forces(self):
+        for k in range(self.active_num[None]):
+            i = self.ball(self.active_balls[k])
+            self.in_contact[i] = 0
             self.vel[i] += self.gravity * self.dt
             if self.wind_on[None] == 1:
                 self.vel[i] += self.wind_force * self.dt
 
             # self.vel[i] += self.vel[i] * self.drag_factor * self.dt
 
-        # self.set_zone()
-        # 检测粒子间的碰撞
-        for i, j in ti.ndrange(self.n, self.n):
-            for m, n in ti.ndrange(self.n, self.n):
-                if i != m or j != n:
-                    pos_diff = self.pos[i, j] - self.pos[m, n]
-                    if pos_diff.norm() <= 2 * self.radius + 0.001:
-                        normal = pos_diff.normalized()
-                        self.vel[i, j] -= min(self.vel[i, j].dot(normal), 0) * normal
-                        normal = -1 * normal
-                        self.vel[m, n] -= min(self.vel[m, n].dot(normal), 0) * normal
-
-        # 限制粒子小球在场景中
-        for i in ti.grouped(self.pos):
-            if self.pos[i][1] < 0.01 + self.radius and self.vel[i][1] < 0:
-                self.vel[i][1] = -1 * self.reflact_factor * self.vel[i][1]
+    @ti.func
+    def contact_impulse(self, p, q):
+        # Impulse on the awake ball p from ball q, computed from the velocities before the collision pass so every
+        # contact sees the same state: zero unless the balls touch and approach each other
+        I = self.ball(p)
+        J = self.ball(q)
+        pos_diff = self.pos[I] - self.pos[J]
+        dist = pos_diff.norm()
+        impulse = ti.Vector.zero(float, 3)
+        if 0 < dist <= self.radii[I] + self.radii[J] + self.contact_margin:
+            self.in_contact[I] = 1
+            self.in_contact[J] = 1
+            inv_mass_q = self.inv_mass[J]
+            if self.sleep_state[J] == self.ASLEEP:
+                if self.vel[I].norm() > self.sleep_velocity:
+                    self.wake(q)
+                else:
+                    # A sleeping ball holds still like a wall
+                    inv_mass_q = 0.0
+            normal = pos_diff / dist
+            approach = (self.vel[I] - self.vel[J]).dot(normal)
+            if approach < 0:
+                impulse = -(1 + self.restitution) * approach / (self.inv_mass[I] + inv_mass_q) * normal
+        return impulse
+
+    @ti.func
+    def grid_impulses(self, grid: ti.template(), p):
+        # Velocity change of the awake ball p from the balls of grid
+        I = self.ball(p)
+        cell = self.pos_to_cell(self.pos[I])
+        dv = ti.Vector.zero(float, 3)
+        for offset in ti.grouped(ti.ndrange((-1, 2), (-1, 2), (-1, 2))):
+            neighbor_cell = cell + offset
+            bucket = grid.cell_to_bucket(neighbor_cell)
+            for l in range(grid.bucket_start(bucket), grid.bucket_count[bucket]):
+                q = grid.sorted_balls[l]
+                J = self.ball(q)
+                # A bucket shared by several cells is visited once for each, so balls count only in their own cell
+                if q != p and (self.pos_to_cell(self.pos[J]) == neighbor_cell).all():
+                    impulse = self.contact_impulse(p, q)
+                    dv += impulse * self.inv_mass[I]
+                    # A woken ball does not visit its contacts before the next step, so it takes the reaction
+                    # here, as in resolve_pair
+                    if self.sleep_state[J] == self.WOKEN:
+                        self.dv[J] -= impulse * self.inv_mass[J]
+        return dv
+
+    # 检测粒子间的碰撞
+    @ti.kernel
+    def collide_grid(self, awake_num: int):
+        # Every awake ball visits all of its contacts and writes its own velocity change. Balls woken here are
+        # still in the sleeping grid and past awake_num in the active list, their velocity change starts at zero.
+        for k in range(awake_num):
+            p = self.active_balls[k]
+            self.dv[self.ball(p)] = self.grid_impulses(self.awake_grid, p) + self.grid_impulses(self.sleep_grid, p)
+
+    def sweep_buffers(self, num):
+        # A power of two long, padded with infinite keys, so the sort covers about the awake balls only
+        size = 1 << max(num - 1, 0).bit_length()
+        if size not in self._sweep_buffers:
+            self._sweep_buffers[size] = (ti.field(float, shape=size), ti.field(int, shape=size))
+        return self._sweep_buffers[size]
+
+    @ti.kernel
+    def sweep_prepare(self, keys: ti.template(), balls: ti.template(), awake_num: int):
+        for k in range(keys.shape[0]):
+            if k < awake_num:
+                p = self.active_balls[k]
+                I = self.ball(p)
+                keys[k] = self.pos[I][0] - self.radii[I]
+                balls[k] = p
+                self.dv[I] = ti.Vector.zero(float, 3)
+            else:
+                keys[k] = ti.math.inf
+                balls[k] = -1
+
+    @ti.kernel
+    def collide_sweep(self, keys: ti.template(), balls: ti.template(), awake_num: int):
+        # Every overlapping pair with an awake ball is found once, and both balls get their share of the impulse
+        # unless the other one sleeps. Pairs of awake balls come from the one whose extent starts first. Sleeping
+        # (or just woken) balls are searched for in their own sorted list, from as far back as the largest reach.
+        for k in range(awake_num):
+            p = balls[k]
+            I = self.ball(p)
+            x_max = keys[k] + 2 * self.radii[I] + self.contact_margin
+            l = k + 1
+            while l < awake_num:
+                if keys[l] > x_max:
+                    break
+                self.resolve_pair(p, balls[l])
+                l += 1
+            x_min = keys[k] - 2 * self.radius - self.contact_margin
+            lo = 0
+            hi = self.sleeping_num[None]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.sleep_keys[mid] < x_min:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            l = lo
+            while l < self.sleeping_num[None]:
+                if self.sleep_keys[l] > x_max:
+                    break
+                self.resolve_pair(p, self.sleep_sweep_balls[l])
+                l += 1
+
+    @ti.func
+    def resolve_pair(self, p, q):
+        I = self.ball(p)
+        J = self.ball(q)
+        impulse = self.contact_impulse(p, q)
+        self.dv[I] += impulse * self.inv_mass[I]
+        if self.sleep_state[J] != self.ASLEEP:
+            self.dv[J] -= impulse * self.inv_mass[J]
+
+    @ti.kernel
+    def apply_impulses(self):
+        for k in range(self.active_num[None]):
+            I = self.ball(self.active_balls[k])
+            self.vel[I] += self.dv[I]
+
+    def collide(self, awake_num):
+        if self.broad_phase == 'grid':
+            self.awake_grid.build(self.active_balls, awake_num)
+            self.collide_grid(awake_num)
+        else:
+            keys, balls = self.sweep_buffers(awake_num)
+            self.sweep_prepare(keys, balls, awake_num)
+            ti.algorithms.parallel_sort(keys, balls)
+            self.collide_sweep(keys, balls, awake_num)
+        self.apply_impulses()
+
+    # 限制粒子小球在场景中
+    @ti.kernel
+    def advance(self):
+        for k in range(self.active_num[None]):
+            i = self.ball(self.active_balls[k])
+            # A ball that sank into the floor is put back on it, so one at rest stays in contact instead of
+            # bouncing across the contact test
+            floor_height = 0.01 + self.radii[i]
+            on_floor = self.pos[i][1] <= floor_height + self.contact_margin
+            if self.pos[i][1] < floor_height:
+                self.pos[i][1] = floor_height
+            if on_floor:
+                friction = ti.max(1 - self.floor_friction * self.dt, 0.0)
+                self.vel[i][0] *= friction
+                self.vel[i][2] *= friction
+            if on_floor and self.vel[i][1] < 0:
+                # The floor carries the weight of a ball touching it, so only the speed it landed with bounces
+                # back, otherwise the gravity of every bounce step keeps small bounces going forever. A ball
+                # landing slower than sleep_velocity stays on the floor.
+                landing = ti.min(self.vel[i][1] + self.gravity[1] * -self.dt, 0.0)
+                if landing > -self.sleep_velocity:
+                    self.vel[i][1] = 0
+                else:
+                    self.vel[i][1] = -1 * self.reflact_factor * landing
 
             if self.pos[i][0] > (self.scene_size / 1.0) * 0.98 and self.vel[i][0] > 0:
                 self.vel[i][0] = -1 * self.reflact_factor * self.vel[i][0]
@@ -113,17 +467,51 @@ class ParticleSystem:
             if self.pos[i][2] > (self.scene_size / 1.0) * 0.98 and self.vel[i][2] > 0:
                 self.vel[i][2] = -1 * self.reflact_factor * self.vel[i][2]
 
-            self.pos[i] += self.dt * self.vel[i]
+            # Supported and still near where it came to rest; a ball in flight is never supported
+            if (on_floor or self.in_contact[i] == 1) and \
+                    (self.pos[i] - self.rest_anchor[i]).norm() < self.sleep_distance:
+                self.still_steps[i] += 1
+            else:
+                self.still_steps[i] = 0
+                self.rest_anchor[i] = self.pos[i]
+            if self.sleep_steps > 0 and self.still_steps[i] >= self.sleep_steps:
+                self.sleep_state[i] = self.ASLEEP
+                self.sleep_changed[None] = 1
+                self.vel[i] = ti.Vector.zero(float, 3)
+                self.dv[i] = ti.Vector.zero(float, 3)
+            else:
+                self.pos[i] += self.dt * self.vel[i]
+
+    def take_step(self):
+        self.collect_awake()
+        if self.sleep_changed[None] == 1:
+            self.sleep_changed[None] = 0
+            self.build_sleeping()
+        awake_num = self.active_num[None]
+        self.apply_forces()
+        self.collide(awake_num)
+        self.advance()
 
     def show_system(self):
 
-        scene.particles(self.vertices, radius=ball_radius * 1, color=(144 / 255.0, 238 / 255.0, 144 / 255.0))
+        scene.particles(self.vertices, radius=ball_radius * 1, per_vertex_radius=self.vertex_radii,
+                        color=(144 / 255.0, 238 / 255.0, 144 / 255.0))
         # for i in range(self.n * self.n):
         #     t = ti.Vector.field(3, float, shape=1)
         #     t[0] = self.vertices[i]
         #     scene.particles(t, radius=ball_radius * 1, color=(144 / 255.0, 238 / 255.0, 144 / 255.0))
 
 
+def settle(n, r, steps, broad_phase='grid', report_every=500):
+    # Headless check of sleeping: a column of balls collapses into a pile that should fall asleep
+    system = ParticleSystem(n, r, broad_phase=broad_phase)
+    system.initialize_column(int(math.ceil(math.sqrt(n))))
+    for step in range(1, steps + 1):
+        system.take_step()
+        if step % report_every == 0 or step == steps:
+            print('step %d t %.2f: %d of %d balls awake' % (step, step * system.dt, system.awake_count(), system.num))
+
+
 def init_scene():
     floor = ti.Vector.field(3, float, shape=2 * 2)
     floor1 = ti.Vector.field(3, float, shape=2 * 2)
@@ -179,14 +567,24 @@ def init_scene():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Balls falling into a box')
+    parser.add_argument('--settle', type=int, default=0,
+                        help='run this many steps of a collapsing column without a window, reporting awake balls')
+    parser.add_argument('--n', type=int, default=33, help='n x n balls')
+    parser.add_argument('--broad-phase', default='grid', choices=['grid', 'sap'])
+    args = parser.parse_args()
 
     ball_radius = 0.1
     ball_center = ti.Vector.field(3, float, shape=(2,))
     ball_center[0] = [0, 0.5, 0]
     ball_center[1] = [0, 0.8, 0]
-    N = 33
+    N = args.n
+
+    if args.settle > 0:
+        settle(N, ball_radius, args.settle, args.broad_phase)
+        sys.exit()
 
-    particleSystem = ParticleSystem(N, ball_radius)
+    particleSystem = ParticleSystem(N, ball_radius, broad_phase=args.broad_phase)
 
     dt = particleSystem.dt
     substeps = int(1 / 60 // dt)
@@ -264,7 +662,8 @@ if __name__ == "__main__":
 
         # particleSystem.show_system()
 
-        scene.particles(particleSystem.vertices, radius=ball_radius * 1, color=(144 / 255.0, 238 / 255.0, 144 / 255.0))
+        scene.particles(particleSystem.vertices, radius=ball_radius * 1, per_vertex_radius=particleSystem.vertex_radii,
+                        color=(144 / 255.0, 238 / 255.0, 144 / 255.0))
 
         canvas.scene(scene)
         window.show()